@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""Replay memory ramps against swapFC in a fake root.
+
+SwapFc runs unmodified on a synthetic /proc/meminfo and /proc/swaps in a
+temporary directory. systemctl, swapoff and losetup are replaced by stubs which
+update the fake /proc/swaps. For each
+scenario the time from a threshold crossing to the swap becoming active, the
+chunks created and freed, and the CPU time used are reported.
+
+Needs the same Python modules as systemd-swap itself, but neither root nor
+memory pressure.
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import sysv_ipc
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIB = 1024 * 1024
+PATH = os.environ["PATH"]
+
+STUBS = {
+    "systemctl": r"""#!/bin/sh
+# Start and stop swap units by editing the fake /proc/swaps.
+swaps="$FAKE_ROOT/proc/swaps"
+unit="$FAKE_ROOT/run/systemd/system/$2"
+case "$1" in
+start)
+    what=$(sed -n 's/^What=//p' "$unit")
+    prio=$(sed -n 's/^Priority=//p' "$unit")
+    size=$(($(stat -c %s "$what") / 1024))
+    (
+        flock 9
+        printf '%s\tfile\t%s\t0\t%s\n' "$what" "$size" "${prio:--2}" >>"$swaps"
+    ) 9>"$swaps.lock"
+    ;;
+stop)
+    exec swapoff "$(sed -n 's/^What=//p' "$unit")"
+    ;;
+esac
+""",
+    "swapoff": r"""#!/bin/sh
+swaps="$FAKE_ROOT/proc/swaps"
+sleep "${SWAPOFF_DELAY:-0}"
+(
+    flock 9
+    awk -v what="$1" '$1 != what' "$swaps" >"$swaps.new"
+    mv "$swaps.new" "$swaps"
+) 9>"$swaps.lock"
+""",
+    "losetup": "#!/bin/sh\necho 'losetup: not available in the fake root' >&2\nexit 1\n",
+}
+
+
+def ramp(t: float, chunk: int) -> Tuple[float, int]:
+    """RAM fills up, then swap usage grows steadily to 6 chunks and drops."""
+    ram = min(0.5 + 0.09 * t, 0.95)
+    if t < 5:
+        return ram, 0
+    if t < 25:
+        return ram, int(6 * chunk * (t - 5) / 20)
+    return ram, int(6 * chunk * max(1 - (t - 25) / 5, 0))
+
+
+def spike(t: float, chunk: int) -> Tuple[float, int]:
+    """RAM runs full at once, 3 chunks worth of swap are needed right away."""
+    if t < 2:
+        return 0.5, 0
+    return 0.97, 3 * chunk if t < 15 else 0
+
+
+def sawtooth(t: float, chunk: int) -> Tuple[float, int]:
+    """Swap usage grows to 3 chunks and drops, three times."""
+    return 0.95, int(3 * chunk * (t % 10) / 8) if t % 10 < 8 else 0
+
+
+# name: (function, duration in seconds)
+SCENARIOS: Dict[str, Tuple[Callable[[float, int], Tuple[float, int]], float]] = {
+    "ramp": (ramp, 45),
+    "spike": (spike, 25),
+    "sawtooth": (sawtooth, 35),
+}
+
+
+def load_module():
+    spec = importlib.util.spec_from_file_location(
+        "systemd_swap", os.path.join(TOP_DIR, "src", "systemd-swap.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeRoot:
+    """A temporary directory standing in for /proc, /run, /etc and the stubs."""
+
+    def __init__(self, ss, ram_size: int, overrides: Dict[str, str]):
+        self.path = tempfile.mkdtemp(prefix="swapfc-bench.")
+        self.ss = ss
+        self.ram_size = ram_size
+        for d in ["proc", "bin", "etc/systemd", "run/systemd", "var/lib"]:
+            os.makedirs(f"{self.path}/{d}")
+        for name, content in STUBS.items():
+            with open(f"{self.path}/bin/{name}", "w") as f:
+                f.write(content)
+            os.chmod(f"{self.path}/bin/{name}", 0o755)
+        with open(f"{self.path}/proc/swaps", "w") as f:
+            f.write("Filename\tType\tSize\tUsed\tPriority\n")
+        self.meminfo_fd = os.open(f"{self.path}/proc/meminfo", os.O_RDWR | os.O_CREAT)
+        self.write_meminfo(0.5, 0, 0)
+        with open(f"{self.path}/etc/systemd/swap.conf", "w") as f:
+            for key, value in overrides.items():
+                f.write(f"{key}={value}\n")
+            f.write(f"swapfc_path={self.path}/var/lib/swapfc\n")
+        os.environ["FAKE_ROOT"] = self.path
+        os.environ["PATH"] = f"{self.path}/bin:{PATH}"
+
+        ss.PROC_MEMINFO = f"{self.path}/proc/meminfo"
+        ss.PROC_SWAPS = f"{self.path}/proc/swaps"
+        ss.RUN_SYSD = f"{self.path}/run/systemd"
+        ss.ETC_SYSD = f"{self.path}/etc/systemd"
+        ss.VEN_SYSD = f"{self.path}/usr/lib/systemd"
+        ss.DEF_CONFIG = os.path.join(TOP_DIR, "include", "swap-default.conf")
+        ss.ETC_CONFIG = f"{ss.ETC_SYSD}/swap.conf"
+        ss.WORK_DIR = f"{ss.RUN_SYSD}/swap"
+        ss.Config.cache_path = f"{ss.RUN_SYSD}/swap-config.cache"
+        ss.RAM_SIZE = ram_size
+        ss.MEMINFO = ss.MemInfo()
+        ss.METRICS = ss.Metrics()
+        ss.sigterm_event.clear()
+        ss.init_directories()
+
+    def write_meminfo(self, ram_used: float, swap_total: int, swap_used: int) -> None:
+        # Rewritten in place with fixed widths: the daemon keeps the file open.
+        mem_free = int(self.ram_size * (1 - ram_used))
+        swap_used = min(swap_used, swap_total)
+        fields = [
+            ("MemTotal", self.ram_size),
+            ("MemFree", mem_free),
+            ("MemAvailable", mem_free),
+            ("SwapTotal", swap_total),
+            ("SwapFree", swap_total - swap_used),
+        ]
+        data = "".join(f"{k + ':':<16}{v // 1024:>16} kB\n" for k, v in fields)
+        os.pwrite(self.meminfo_fd, data.encode(), 0)
+
+    def swaps(self) -> List[int]:
+        """Sizes of the active swaps, in bytes."""
+        with open(self.ss.PROC_SWAPS) as f:
+            return [int(line.split()[2]) * 1024 for line in f.read().splitlines()[1:]]
+
+    def remove(self) -> None:
+        os.close(self.meminfo_fd)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Driver(threading.Thread):
+    """Feed the scenario to the fake meminfo, time the reactions of swapFC."""
+
+    def __init__(
+        self,
+        root: FakeRoot,
+        scenario: Callable[[float, int], Tuple[float, int]],
+        duration: float,
+        speed: float,
+        chunk: int,
+        config,
+    ):
+        super().__init__(daemon=True)
+        self.root = root
+        self.scenario = scenario
+        self.duration = duration / speed
+        self.speed = speed
+        self.chunk = chunk
+        self.free_ram_perc = config.get("swapfc_free_ram_perc", int)
+        self.free_swap_perc = config.get("swapfc_free_swap_perc", int)
+        self.max_count = config.get("swapfc_max_count", int)
+        self.latencies = []
+        self.missed = 0
+        self.cpu_time = 0.0
+
+    def run(self) -> None:
+        start = time.monotonic()
+        # Time of the threshold crossing and the number of swaps back then.
+        pending = None
+        while True:
+            now = time.monotonic()
+            t = now - start
+            if t >= self.duration:
+                break
+            ram_used, swap_used = self.scenario(t * self.speed, self.chunk)
+            swaps = self.root.swaps()
+            swap_total = sum(swaps)
+            self.root.write_meminfo(ram_used, swap_total, swap_used)
+            if pending and len(swaps) > pending[1]:
+                self.latencies.append(now - pending[0])
+                pending = None
+            if not swaps:
+                needed = (1 - ram_used) * 100 < self.free_ram_perc
+            else:
+                swap_free = swap_total - min(swap_used, swap_total)
+                needed = (
+                    swap_free * 100 < self.free_swap_perc * swap_total
+                    and len(swaps) < self.max_count
+                )
+            if needed and pending is None:
+                pending = (now, len(swaps))
+            elif not needed and pending:
+                self.missed += 1
+                pending = None
+            time.sleep(0.01)
+        self.cpu_time = time.thread_time()
+        self.root.ss.sigterm_event.set()
+
+
+def bench(ss, name: str, args) -> Dict[str, object]:
+    scenario, duration = SCENARIOS[name]
+    chunk = args.chunk_size * MIB
+    overrides = {
+        "swapfc_enabled": "1",
+        "swapfc_chunk_size": f"{args.chunk_size}M",
+        "swapfc_max_count": str(args.max_count),
+        "swapfc_frequency": "1",
+        "swapfc_psi_enabled": "0",
+        "swapfc_policy": args.policy,
+        "swapfc_alloc_strategy": args.alloc_strategy,
+        "swapfc_spare_count": str(args.spare_count),
+        "swap_activation": "unit",
+    }
+    root = FakeRoot(ss, args.ram_size * MIB, overrides)
+    try:
+        config = ss.Config()
+        sem = sysv_ipc.Semaphore(None, sysv_ipc.IPC_CREX)
+        try:
+            rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+            rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.monotonic()
+            swap_fc = ss.SwapFc(config, sem, ss.SwapActivator("unit"))
+            driver = Driver(root, scenario, duration, args.speed, chunk, config)
+            driver.start()
+            swap_fc.run()
+            driver.join()
+            if swap_fc.drainer:
+                swap_fc.drainer.join()
+            wall_time = time.monotonic() - start
+            after_self = resource.getrusage(resource.RUSAGE_SELF)
+            after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        finally:
+            sem.remove()
+    finally:
+        root.remove()
+
+    def cpu(before, after) -> float:
+        return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+    latencies = [round(v * 1000, 1) for v in driver.latencies]
+    counters = {name: value for (name, _), value in ss.METRICS.values.items()}
+    return {
+        "scenario": name,
+        "wall_time": round(wall_time, 2),
+        "latency_ms": {
+            "count": len(latencies),
+            "min": min(latencies, default=None),
+            "median": statistics.median(latencies) if latencies else None,
+            "max": max(latencies, default=None),
+        },
+        "missed": driver.missed,
+        "chunks_created": counters.get("swapfc_allocations_total", 0),
+        "chunks_destroyed": counters.get("swapfc_deallocations_total", 0),
+        "enospc": counters.get("swapfc_enospc_total", 0),
+        # The driver thread runs in the same process, its share is taken out.
+        "cpu_daemon": round(cpu(rusage_self, after_self) - driver.cpu_time, 3),
+        "cpu_tools": round(cpu(rusage_children, after_children), 3),
+    }
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help=f"scenarios to replay: {', '.join(SCENARIOS)} (default: all)",
+    )
+    argparser.add_argument("--ram-size", type=int, default=8192, help="in MiB")
+    argparser.add_argument("--chunk-size", type=int, default=64, help="in MiB")
+    argparser.add_argument("--max-count", type=int, default=32)
+    argparser.add_argument(
+        "--policy", choices=["threshold", "predictive"], default="threshold"
+    )
+    argparser.add_argument(
+        "--alloc-strategy",
+        choices=["auto", "fallocate", "odirect", "fadvise"],
+        default="auto",
+    )
+    argparser.add_argument("--spare-count", type=int, default=0)
+    argparser.add_argument(
+        "--swapoff-delay", type=float, default=0, help="seconds per stub swapoff"
+    )
+    argparser.add_argument(
+        "--speed", type=float, default=1, help="replay the scenarios faster"
+    )
+    argparser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = argparser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            argparser.error(f"unknown scenario: {name}")
+    os.environ["SWAPOFF_DELAY"] = str(args.swapoff_delay)
+    ss = load_module()
+    for name in args.scenarios or list(SCENARIOS):
+        result = bench(ss, name, args)
+        if args.json:
+            print(json.dumps(result))
+            continue
+        latency = result["latency_ms"]
+        print(
+            f"{name}: {result['chunks_created']} chunk(s) created, "
+            f"{result['chunks_destroyed']} freed, "
+            f"latency min/median/max {latency['min']}/{latency['median']}/"
+            f"{latency['max']} ms over {latency['count']} crossing(s) "
+            f"({result['missed']} missed), CPU daemon {result['cpu_daemon']}s "
+            f"tools {result['cpu_tools']}s, wall {result['wall_time']}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,40 +7,196 @@
 
 from __future__ import annotations
 
+import abc
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import errno
+import fcntl
 import glob
+import json
+import math
+import mmap
+import operator
 import os
-import pickle
+import random
 import re
+import select
 import shutil
 import signal
+import socket
 import stat
+import struct
 import subprocess
 import sys
 import threading
 import time
 import types
-from typing import List, Dict, Type, Optional, Tuple, NoReturn
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    List,
+    Dict,
+    Type,
+    Optional,
+    Tuple,
+    NoReturn,
+    Union,
+)
 
 import systemd.daemon
+import systemd.journal
 import sysv_ipc
 
 
-def get_mem_stats(fields: List[str]) -> Dict[str, int]:
-    stats = {}
-    with open("/proc/meminfo") as meminfo:
-        for line in meminfo:
-            items = line.split()
-            key = items[0][:-1]
-            if items[2] == "kB" and key in fields:
-                fields.remove(key)
-                stats[key] = int(items[1]) * 1024
-            if not fields:
-                break
-    assert len(fields) == 0
-    return stats
+class ProcFile:
+    """A kernel statistics file kept open and re-read into the same buffer."""
+
+    def __init__(self, path: str, size: int = 4096):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buf = bytearray(size)
+
+    def read(self) -> memoryview:
+        size = os.preadv(self.fd, [self.buf], 0)
+        while size == len(self.buf):
+            # The file did not fit, grow the buffer once and for all.
+            self.buf = bytearray(len(self.buf) * 2)
+            size = os.preadv(self.fd, [self.buf], 0)
+        return memoryview(self.buf)[:size]
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class MemSample:
+    __slots__ = (
+        "time",
+        "mem_total",
+        "mem_free",
+        "mem_available",
+        "swap_total",
+        "swap_free",
+    )
+
+    def __init__(self, stats: Dict[bytes, int]):
+        self.time = time.monotonic()
+        self.mem_total = stats.get(b"MemTotal", 0)
+        self.mem_free = stats.get(b"MemFree", 0)
+        self.mem_available = stats.get(b"MemAvailable", 0)
+        self.swap_total = stats.get(b"SwapTotal", 0)
+        self.swap_free = stats.get(b"SwapFree", 0)
+
+    @property
+    def swap_used(self) -> int:
+        return self.swap_total - self.swap_free
+
+    def free_ram_perc(self) -> int:
+        return round((self.mem_free * 100) / self.mem_total)
+
+    def free_swap_perc(self) -> int:
+        # Minimum for total is 1 to prevent divide by zero.
+        return round((self.swap_free * 100) / max(self.swap_total, 1))
+
+
+class MemInfo:
+    """Sampler of /proc/meminfo, keeping the last samples in a ring buffer."""
+
+    fields_re = re.compile(
+        rb"^(MemTotal|MemFree|MemAvailable|SwapTotal|SwapFree):\s+(\d+) kB$", re.M
+    )
+
+    def __init__(self, history: int = 64):
+        self.file = ProcFile(PROC_MEMINFO)
+        self.history = collections.deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def sample(self) -> MemSample:
+        with self.lock:
+            stats = {
+                match.group(1): int(match.group(2)) * 1024
+                for match in self.fields_re.finditer(self.file.read())
+            }
+            sample = MemSample(stats)
+            self.history.append(sample)
+        return sample
+
+    def rate(self, field: str, window: float = 10) -> float:
+        """Least squares slope of a sample field per second over the last window."""
+        with self.lock:
+            if not self.history:
+                return 0.0
+            now = self.history[-1].time
+            samples = [s for s in self.history if now - s.time <= window]
+        if len(samples) < 2:
+            return 0.0
+        mean_time = sum(s.time for s in samples) / len(samples)
+        mean_value = sum(getattr(s, field) for s in samples) / len(samples)
+        variance = sum((s.time - mean_time) ** 2 for s in samples)
+        if variance == 0:
+            return 0.0
+        covariance = sum(
+            (s.time - mean_time) * (getattr(s, field) - mean_value) for s in samples
+        )
+        return covariance / variance
+
+
+class CgroupMemory:
+    """Memory usage and limits of a cgroup v2, from files kept open."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files = {}
+        for name in ["memory.current", "memory.high", "memory.max", "memory.events"]:
+            self.files[name] = ProcFile(f"{path}/{name}", 512)
+        # Missing without swap accounting.
+        if os.path.isfile(f"{path}/memory.swap.current"):
+            self.files["memory.swap.current"] = ProcFile(
+                f"{path}/memory.swap.current", 512
+            )
+        self.events = self.limit_events()
+
+    def read_int(self, name: str) -> Optional[int]:
+        value = bytes(self.files[name].read()).strip()
+        return None if value == b"max" else int(value)
+
+    def limit_events(self) -> int:
+        events = dict(
+            line.split()
+            for line in bytes(self.files["memory.events"].read()).splitlines()
+        )
+        return int(events.get(b"high", 0)) + int(events.get(b"max", 0))
+
+    def shortage(self, free_perc: int) -> Optional[str]:
+        """Return why the cgroup is short of memory, None if it isn't."""
+        events = self.limit_events()
+        new_events = events - self.events
+        self.events = events
+        current = self.read_int("memory.current")
+        swap = ""
+        if "memory.swap.current" in self.files:
+            swap = f", {self.read_int('memory.swap.current') // (1024 * 1024)} MiB swap"
+        if new_events:
+            return f"hit its limit {new_events} time(s){swap}"
+        limits = [self.read_int("memory.high"), self.read_int("memory.max")]
+        limits = [limit for limit in limits if limit is not None]
+        if not limits:
+            return None
+        limit = min(limits)
+        curr_free_perc = round(max(limit - current, 0) * 100 / max(limit, 1))
+        if curr_free_perc < free_perc:
+            return f"has {curr_free_perc}% of its limit free{swap}"
+        return None
 
+    def close(self) -> None:
+        for file in self.files.values():
+            file.close()
 
+
+START_TIME = time.monotonic()
 # Global variables.
 # NCPU and RAM_SIZE are referenced inside of `swap-default.conf`.
 NCPU = os.cpu_count() or 1
@@ -49,42 +205,162 @@ ETC_SYSD = "/etc/systemd"
 VEN_SYSD = "/usr/lib/systemd"
 DEF_CONFIG = "/usr/share/systemd-swap/swap-default.conf"
 ETC_CONFIG = f"{ETC_SYSD}/swap.conf"
-RAM_SIZE = get_mem_stats(["MemTotal"])["MemTotal"]
-PAGE_SIZE = int(
-    subprocess.run(
-        ["getconf", "PAGESIZE"], check=True, text=True, stdout=subprocess.PIPE
-    ).stdout
-)
+PROC_MEMINFO = "/proc/meminfo"
+PROC_SWAPS = "/proc/swaps"
+PROC_VMSTAT = "/proc/vmstat"
+
+
+class Metrics:
+    """Counters, gauges and histograms, exported in the Prometheus text format."""
+
+    prefix = "systemd_swap"
+    buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.helps = {}
+        self.values = {}
+        self.collectors = []
+
+    def describe(self, name: str, metric_type: str, help_text: str) -> None:
+        self.types[name] = metric_type
+        self.helps[name] = help_text
+
+    @staticmethod
+    def key(name: str, labels: Dict[str, object]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def reset(self, name: str) -> None:
+        with self.lock:
+            for key in [k for k in self.values if k[0] == name]:
+                del self.values[key]
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        for bucket in self.buckets:
+            if seconds <= bucket:
+                self.inc(f"{name}_bucket", 1, le=bucket, **labels)
+            else:
+                self.inc(f"{name}_bucket", 0, le=bucket, **labels)
+        self.inc(f"{name}_bucket", 1, le="+Inf", **labels)
+        self.inc(f"{name}_sum", seconds, **labels)
+        self.inc(f"{name}_count", 1, **labels)
+
+    @staticmethod
+    def sort_key(item: Tuple[Tuple[str, Tuple], float]) -> Tuple:
+        (name, labels), _ = item
+        # Buckets must be listed in increasing order, after the other labels.
+        le = dict(labels).get("le")
+        return name, [l for l in labels if l[0] != "le"], float(le or 0)
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except (OSError, ValueError, IndexError) as e:
+                debug(f"Metrics: collector failed: {e}")
+        lines = []
+        described = set()
+        with self.lock:
+            for (name, labels), value in sorted(self.values.items(), key=self.sort_key):
+                base = re.sub(r"_(bucket|sum|count)$", "", name)
+                if base not in self.types:
+                    base = name
+                if base not in described and base in self.types:
+                    described.add(base)
+                    lines.append(f"# HELP {self.prefix}_{base} {self.helps[base]}")
+                    lines.append(f"# TYPE {self.prefix}_{base} {self.types[base]}")
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+                if label_str:
+                    label_str = f"{{{label_str}}}"
+                lines.append(f"{self.prefix}_{name}{label_str} {value}")
+        return "\n".join(lines) + "\n"
+
+
+MEMINFO = MemInfo()
+METRICS = Metrics()
+RAM_SIZE = MEMINFO.sample().mem_total
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
 WORK_DIR = "/run/systemd/swap"
 LOCK_STARTED = f"{WORK_DIR}/.started"
 ZSWAP_M = "/sys/module/zswap"
 ZSWAP_M_P = "/sys/module/zswap/parameters"
+ZSWAP_D = "/sys/kernel/debug/zswap"
+PSI_MEMORY = "/proc/pressure/memory"
+CGROUP_ROOT = "/sys/fs/cgroup"
+SWAP_FLAG_PREFER = 0x8000
+SWAP_FLAG_PRIO_MASK = 0x7FFF
+SWAP_FLAG_DISCARD = 0x10000
 KMAJOR, KMINOR = [int(v) for v in os.uname().release.split(".")[0:2]]
 IS_DEBUG = False
+LIBC = ctypes.CDLL(None, use_errno=True)
 sigterm_event = threading.Event()
-
-# Should not be a global variable, rework necessary
-zswap_parameters = {}
+# statfs(2) f_type values, from linux/magic.h.
+FS_MAGIC = {
+    0x9123683E: "btrfs",
+    # Named like stat -f does, ext4 included.
+    0xEF53: "ext2/ext3",
+    0x58465342: "xfs",
+    0x01021994: "tmpfs",
+    0xF2F52010: "f2fs",
+    0xCA451A4E: "bcachefs",
+    0x2FC12FC1: "zfs",
+    0x794C7630: "overlay",
+    0x6969: "nfs",
+}
+# The root directory of a btrfs subvolume always has this inode number.
+BTRFS_FIRST_FREE_OBJECTID = 256
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_NOCOW_FL = 0x00800000
+FS_EXTENT_FL = 0x00080000
+
+
+def c_div(a: int, b: int) -> int:
+    if b == 0:
+        raise ValueError("division by 0")
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def c_mod(a: int, b: int) -> int:
+    return a - b * c_div(a, b)
 
 
 class Config:
+    cache_path = f"{RUN_SYSD}/swap-config.cache"
+    # Lowest precedence first, as in the ARITHMETIC EVALUATION section of bash(1).
+    arith_binary = [
+        {"|": operator.or_},
+        {"^": operator.xor},
+        {"&": operator.and_},
+        {"<<": operator.lshift, ">>": operator.rshift},
+        {"+": operator.add, "-": operator.sub},
+        {"*": operator.mul, "/": c_div, "%": c_mod},
+    ]
+    arith_token_re = re.compile(
+        r"\s*(?:(0[xX][0-9a-fA-F]+|[0-9]+)|([A-Za-z_][A-Za-z0-9_]*)"
+        r"|(\*\*|<<|>>|[-+*/%()&|^~]))"
+    )
+    name_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+    # Characters which would make the shell do more than expanding variables.
+    shell_special = set("\\`;&|<>(){}[]*?~!")
+
     def __init__(self):
         os.environ["NCPU"] = str(NCPU)
         os.environ["RAM_SIZE"] = str(RAM_SIZE)
-        self.config = {}
-        # Load default values.
-        if os.path.isfile(DEF_CONFIG):
-            try:
-                self.config.update(Config.parse_config(DEF_CONFIG))
-            except OSError:
-                error(f"Error loading {DEF_CONFIG}")
-        # Config precedence follows systemd scheme:
-        # etc > run > lib for all fragments > /etc/systemd/swap.conf
-        if os.path.isfile(ETC_CONFIG):
-            try:
-                self.config.update(Config.parse_config(ETC_CONFIG))
-            except OSError:
-                warn(f"Could not load {DEF_CONFIG}")
         config_files = {}
         for path in [VEN_SYSD, RUN_SYSD, ETC_SYSD]:
             path += "/swap.conf.d"
@@ -98,15 +374,43 @@ class Config:
         debug(f"Selected configuration artifacts: {list(config_files.values())}")
         # Sort lexicographically.
         config_files = dict(sorted(config_files.items()))
+        all_files = [f for f in [DEF_CONFIG, ETC_CONFIG] if os.path.isfile(f)]
+        all_files += config_files.values()
+        cache_key = Config.cache_key(all_files)
+        self.config = Config.load_cache(cache_key)
+        if self.config is not None:
+            debug(f"Using cached configuration from {Config.cache_path}")
+            return
+        config = {}
+        # Load default values.
+        if os.path.isfile(DEF_CONFIG):
+            try:
+                config.update(Config.parse_config(DEF_CONFIG))
+            except OSError:
+                error(f"Error loading {DEF_CONFIG}")
+        # Config precedence follows systemd scheme:
+        # etc > run > lib for all fragments > /etc/systemd/swap.conf
+        if os.path.isfile(ETC_CONFIG):
+            try:
+                config.update(Config.parse_config(ETC_CONFIG))
+            except OSError:
+                warn(f"Could not load {DEF_CONFIG}")
         for config_file in config_files.values():
             info(f"Load: {config_file}")
-            self.config.update(Config.parse_config(config_file))
+            config.update(Config.parse_config(config_file))
+        self.config = Config.evaluate(config)
+        if cache_key is not None:
+            Config.save_cache(cache_key, self.config)
 
     def get(self, key: str, as_type: Type = str) -> as_type:
         if as_type is bool:
-            return self.config[key].lower() in ["yes", "y", "1", "true"]
+            return Config.is_yes(self.config[key])
         return as_type(self.config[key])
 
+    @staticmethod
+    def is_yes(value: str) -> bool:
+        return value.lower() in ["yes", "y", "1", "true"]
+
     @staticmethod
     def parse_config(file: str) -> Dict[str, str]:
         config = {}
@@ -118,6 +422,29 @@ class Config:
             if line.startswith("#") or "=" not in line:
                 continue
             key, value = line.split("=", 1)
+            config[key] = value
+        return config
+
+    @staticmethod
+    def evaluate(raw: Dict[str, str]) -> Dict[str, str]:
+        try:
+            shell_fallback = Config.is_yes(
+                Config.expand(raw.get("config_shell_fallback", "0"))
+            )
+        except ValueError:
+            shell_fallback = False
+        config = {}
+        for key, value in raw.items():
+            try:
+                config[key] = Config.expand(value)
+                continue
+            except ValueError as e:
+                if not shell_fallback:
+                    error(
+                        f"Can't evaluate {key}={value}: {e}, set "
+                        "config_shell_fallback=1 to evaluate it with the shell"
+                    )
+                debug(f"Evaluating {key} with the shell: {e}")
             config[key] = subprocess.run(
                 [f"echo {value}"],
                 shell=True,
@@ -127,33 +454,956 @@ class Config:
             ).stdout.rstrip()
         return config
 
+    @staticmethod
+    def expand(value: str) -> str:
+        """Return what `echo {value}` prints, without spawning a shell.
+
+        Only quotes, inline comments, $VAR, ${VAR} and $(( )) are supported, which
+        covers swap-default.conf. Anything else raises ValueError.
+        """
+        words = []
+        word = None
+        quote = None
+        i = 0
+        while i < len(value):
+            char = value[i]
+            if quote == "'":
+                if char == "'":
+                    quote = None
+                else:
+                    word += char
+                i += 1
+            elif char == "$":
+                text, i = Config.expand_dollar(value, i)
+                if quote is None:
+                    text = " ".join(text.split())
+                if text or word is not None:
+                    word = (word or "") + text
+            elif quote == '"':
+                if char == '"':
+                    quote = None
+                elif char in "\\`":
+                    raise ValueError(f"unsupported character {char!r}")
+                else:
+                    word += char
+                i += 1
+            elif char.isspace():
+                if word is not None:
+                    words.append(word)
+                    word = None
+                i += 1
+            elif char == "#" and word is None:
+                break
+            elif char in "'\"":
+                quote = char
+                word = word or ""
+                i += 1
+            elif char in Config.shell_special:
+                raise ValueError(f"unsupported character {char!r}")
+            else:
+                word = (word or "") + char
+                i += 1
+        if quote:
+            raise ValueError("unterminated quote")
+        if word is not None:
+            words.append(word)
+        return " ".join(words)
+
+    @staticmethod
+    def expand_dollar(value: str, i: int) -> Tuple[str, int]:
+        if value.startswith("$((", i):
+            depth = 0
+            for j in range(i + 3, len(value)):
+                if value[j] == "(":
+                    depth += 1
+                elif value[j] == ")" and depth:
+                    depth -= 1
+                elif value[j] == ")":
+                    if not value.startswith("))", j):
+                        break
+                    return str(Config.eval_arithmetic(value[i + 3 : j])), j + 2
+            raise ValueError("unterminated $((")
+        if value.startswith("${", i):
+            end = value.find("}", i)
+            name = value[i + 2 : end]
+            if end < 0 or not Config.name_re.fullmatch(name):
+                raise ValueError(f"unsupported expansion {value[i:]}")
+            return os.environ.get(name, ""), end + 1
+        match = Config.name_re.match(value, i + 1)
+        if match:
+            return os.environ.get(match.group(), ""), match.end()
+        if value.startswith("$(", i):
+            raise ValueError("command substitution is not supported")
+        return "$", i + 1
+
+    @staticmethod
+    def eval_arithmetic(expr: str) -> int:
+        def expand_var(match: re.Match) -> str:
+            return os.environ.get(match.group(1) or match.group(2), "") or "0"
+
+        expr = re.sub(r"\$\{(\w+)\}|\$(\w+)", expand_var, expr).rstrip()
+        tokens = []
+        pos = 0
+        while pos < len(expr):
+            match = Config.arith_token_re.match(expr, pos)
+            if not match:
+                raise ValueError(f"unsupported arithmetic {expr!r}")
+            number, name, op = match.groups()
+            if number:
+                if number[:2] in ["0x", "0X"]:
+                    tokens.append(int(number, 16))
+                else:
+                    tokens.append(int(number, 8 if number[0] == "0" else 10))
+            elif name:
+                tokens.append(int(os.environ.get(name, "") or 0))
+            else:
+                tokens.append(op)
+            pos = match.end()
+        tokens.append(None)
+        pos = 0
+
+        def take() -> Union[int, str, None]:
+            nonlocal pos
+            pos += 1
+            return tokens[pos - 1]
+
+        def binary(level: int) -> int:
+            if level == len(Config.arith_binary):
+                return power()
+            left = binary(level + 1)
+            while tokens[pos] in Config.arith_binary[level]:
+                func = Config.arith_binary[level][take()]
+                left = func(left, binary(level + 1))
+            return left
+
+        def power() -> int:
+            base = unary()
+            if tokens[pos] == "**":
+                take()
+                exponent = power()
+                if exponent < 0:
+                    raise ValueError("exponent less than 0")
+                return base**exponent
+            return base
+
+        def unary() -> int:
+            token = take()
+            if token == "-":
+                return -unary()
+            if token == "+":
+                return unary()
+            if token == "~":
+                return ~unary()
+            if token == "(":
+                result = binary(0)
+                if take() != ")":
+                    raise ValueError(f"missing ')' in {expr!r}")
+                return result
+            if isinstance(token, int):
+                return token
+            raise ValueError(f"syntax error in {expr!r}")
+
+        result = binary(0)
+        if tokens[pos] is not None:
+            raise ValueError(f"syntax error in {expr!r}")
+        return result
+
+    @staticmethod
+    def cache_key(files: List[str]) -> Optional[list]:
+        # The evaluated values depend on NCPU and RAM_SIZE as well.
+        key = [NCPU, RAM_SIZE]
+        try:
+            for file in files:
+                st = os.stat(file)
+                key.append([file, os.path.realpath(file), st.st_mtime_ns, st.st_size])
+        except OSError:
+            return None
+        return key
+
+    @classmethod
+    def load_cache(cls, key: Optional[list]) -> Optional[Dict[str, str]]:
+        if key is None:
+            return None
+        try:
+            with open(cls.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or cache.get("key") != key:
+            return None
+        return cache.get("config")
+
+    @classmethod
+    def save_cache(cls, key: list, config: Dict[str, str]) -> None:
+        try:
+            write(json.dumps({"key": key, "config": config}), f"{cls.cache_path}.new")
+            os.replace(f"{cls.cache_path}.new", cls.cache_path)
+        except OSError:
+            debug(f"Can't write {cls.cache_path}")
 
-class DestroyInfo:
-    pickle_path = f"{WORK_DIR}/destroy_info.pickle"
 
-    def __init__(self, zswap_parameters: Dict[str, str]):
-        self.zswap_parameters = zswap_parameters
+class StateManifest:
+    """What systemd-swap has set up, keyed by the names /proc/swaps uses."""
 
-    def get_zswap_parameters(self) -> Dict[str, str]:
-        return self.zswap_parameters
+    path = f"{WORK_DIR}/state.json"
+    version = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.zswap_parameters = {}
+        self.swaps = {}
 
     def save(self) -> None:
-        with open(self.pickle_path, "wb") as f:
-            pickle.dump(self, f)
+        with self.lock:
+            data = {
+                "version": self.version,
+                "zswap_parameters": self.zswap_parameters,
+                "swaps": self.swaps,
+            }
+            write(json.dumps(data, indent=2), f"{self.path}.new")
+            os.replace(f"{self.path}.new", self.path)
 
     @classmethod
-    def load(cls) -> Optional[cls]:
+    def load(cls) -> Optional[StateManifest]:
         try:
-            with open(cls.pickle_path, "rb") as f:
-                return pickle.load(f)
-        except:
+            data = json.loads(read(cls.path))
+        except (OSError, ValueError):
             return None
+        if not isinstance(data, dict) or data.get("version") != cls.version:
+            warn(f"Ignoring {cls.path}: unknown version")
+            return None
+        state = cls()
+        state.zswap_parameters = data.get("zswap_parameters", {})
+        state.swaps = data.get("swaps", {})
+        return state
+
+    def add(self, what: str, subsystem: str, unit: str, **details) -> None:
+        record = {"subsystem": subsystem, "unit": unit, "created": time.time()}
+        record.update(details)
+        with self.lock:
+            self.swaps[os.path.realpath(what)] = record
+        self.save()
+
+    def remove(self, what: str) -> None:
+        with self.lock:
+            record = self.swaps.pop(os.path.realpath(what), None)
+        if record is not None:
+            self.save()
+
+    def get(self, what: str) -> Optional[Dict[str, Any]]:
+        return self.swaps.get(os.path.realpath(what))
+
+    def by_subsystem(self, subsystem: str) -> Dict[str, Dict[str, Any]]:
+        return {w: r for w, r in self.swaps.items() if r["subsystem"] == subsystem}
+
+    def reconcile(
+        self, active_swaps: Dict[str, SwapEntry]
+    ) -> Dict[str, Dict[str, Any]]:
+        """Drop and return the records of swaps that aren't active anymore."""
+        with self.lock:
+            stale = {w: r for w, r in self.swaps.items() if w not in active_swaps}
+            for what in stale:
+                del self.swaps[what]
+        return stale
+
+
+class PsiMonitor:
+    """Block in poll() until a PSI stall trigger fires, see accounting/psi.rst."""
+
+    def __init__(self, stall_us: int, window_us: int):
+        self.trigger = f"some {stall_us} {window_us}".encode() + b"\0"
+        self.triggers = {}
+        self.poller = select.poll()
+        # A signal interrupts poll(), but PEP 475 silently restarts it. Let the
+        # interpreter write to a pipe on every signal so SIGTERM wakes us up.
+        self.wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        self.poller.register(self.wakeup_r, select.POLLIN)
+
+    def add_trigger(self, path: str) -> None:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            os.write(fd, self.trigger)
+        except OSError:
+            os.close(fd)
+            raise
+        self.poller.register(fd, select.POLLPRI)
+        self.triggers[fd] = path
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Return True if a trigger fired, False on timeout or signal."""
+        fired = False
+        events = self.poller.poll(None if timeout is None else timeout * 1000)
+        for fd, event in events:
+            if fd == self.wakeup_r:
+                try:
+                    os.read(fd, 64)
+                except BlockingIOError:
+                    pass
+            elif event & select.POLLERR:
+                # The cgroup was removed.
+                warn(f"PSI trigger on {self.triggers[fd]} is gone")
+                self.poller.unregister(fd)
+                os.close(fd)
+                del self.triggers[fd]
+            elif event & select.POLLPRI:
+                fired = True
+        return fired
+
+
+class ChunkAllocator:
+    """Fill swap chunk files without leaving dirty page cache behind."""
+
+    strategies = ["fallocate", "odirect", "fadvise"]
+    # Filesystems which can swap on unwritten (fallocated) extents, ext only if it
+    # uses extents at all.
+    fallocate_fs = ["ext2/ext3", "btrfs"]
+    if (KMAJOR, KMINOR) >= (4, 18):
+        fallocate_fs.append("xfs")
+    write_size = 8 * 1024 * 1024
+
+    def __init__(self, strategy: str, fs_type: str, path: str):
+        can_fallocate = fs_type in self.fallocate_fs
+        if fs_type == "ext2/ext3":
+            try:
+                can_fallocate = bool(get_inode_flags(path) & FS_EXTENT_FL)
+            except OSError:
+                can_fallocate = False
+        if strategy == "auto":
+            strategy = "fallocate" if can_fallocate else "odirect"
+        elif strategy not in self.strategies:
+            warn(f"swapfc_alloc_strategy {strategy} is unknown, reset to auto")
+            strategy = "fallocate" if can_fallocate else "odirect"
+        elif strategy == "fallocate" and not can_fallocate:
+            warn(f"swapFC: {fs_type} may not support swap on fallocated files")
+        self.strategy = strategy
+        self.last_duration = 0.0
+        self.last_rate = 0.0
+        info(f"swapFC: allocating chunks with {self.strategy}")
+
+    def allocate(self, path: str, size: int) -> None:
+        start_time = time.monotonic()
+        if self.strategy == "fallocate":
+            self.fallocate(path, size)
+        elif self.strategy == "odirect":
+            try:
+                self.odirect(path, size)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # The filesystem doesn't support O_DIRECT (ex. tmpfs).
+                warn("swapFC: O_DIRECT is not supported, fall back to fadvise")
+                self.strategy = "fadvise"
+        if self.strategy == "fadvise":
+            self.fadvise(path, size)
+        self.last_duration = time.monotonic() - start_time
+        self.last_rate = size / max(self.last_duration, 1e-6) / (1024 * 1024)
+        info(
+            f"swapFC: {self.strategy} of {size} byte(s) took "
+            f"{self.last_duration:.3f}s ({self.last_rate:.0f} MB/s)"
+        )
+
+    @staticmethod
+    def fallocate(path: str, size: int) -> None:
+        fd = os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+        try:
+            os.posix_fallocate(fd, 0, size)
+        finally:
+            os.close(fd)
+
+    def odirect(self, path: str, size: int) -> None:
+        with aligned_buffer(self.write_size) as zeros:
+            fd = os.open(path, os.O_WRONLY | os.O_CLOEXEC | os.O_DIRECT)
+            try:
+                offset = 0
+                aligned_size = size - size % PAGE_SIZE
+                while offset < aligned_size:
+                    length = min(self.write_size, aligned_size - offset)
+                    offset += os.pwrite(fd, memoryview(zeros)[:length], offset)
+            finally:
+                os.close(fd)
+        if size > offset:
+            self.fadvise(path, size, offset)
+
+    def fadvise(self, path: str, size: int, offset: int = 0) -> None:
+        zeros = bytes(self.write_size)
+        fd = os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+        try:
+            while offset < size:
+                length = min(self.write_size, size - offset)
+                written = os.pwrite(fd, memoryview(zeros)[:length], offset)
+                # Write back and drop each batch before dirtying the next one.
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, offset, written, os.POSIX_FADV_DONTNEED)
+                offset += written
+        finally:
+            os.close(fd)
+
+
+class SwapActivator:
+    """Activate swap through unit files, transient units or swapon(2)."""
+
+    backends = ["unit", "transient", "swapon"]
+    activation_timeout = 60
+
+    def __init__(self, backend: str, state: Optional[StateManifest] = None):
+        if backend not in self.backends:
+            warn(f"swap_activation {backend} is unknown, reset to unit")
+            backend = "unit"
+        self.backend = backend
+        # Only units in /run/systemd need a daemon-reload, the others are kept in
+        # WORK_DIR for stop and status.
+        self.unit_dir = (
+            f"{RUN_SYSD}/system" if backend == "unit" else f"{WORK_DIR}/units"
+        )
+        self.state = state
+        self.pending = {}
+        self.reload_needed = False
+
+    def add(
+        self,
+        what: str,
+        tag: str,
+        priority: Optional[int] = None,
+        options: Optional[str] = None,
+        **details,
+    ) -> str:
+        with span("unit_generate", what=what):
+            unit_name = gen_swap_unit(what, tag, priority, options, self.unit_dir)
+        what = os.path.realpath(what)
+        self.pending[unit_name] = (what, priority, options, tag, details)
+        self.reload_needed = self.backend == "unit"
+        return unit_name
+
+    def reload(self) -> None:
+        if self.reload_needed:
+            with span("unit_reload"):
+                subprocess.run(["systemctl", "daemon-reload"], check=True)
+            self.reload_needed = False
+
+    def start(self, unit_name: str, check: bool = False) -> bool:
+        what, priority, options, tag, details = self.pending.pop(unit_name)
+        with span("unit_start", what=what, backend=self.backend):
+            if self.backend == "unit":
+                ok = subprocess.run(["systemctl", "start", unit_name]).returncode == 0
+            elif self.backend == "transient":
+                ok = self.start_transient(unit_name, what, priority, options)
+            else:
+                try:
+                    sys_swapon(what, priority, options)
+                    ok = True
+                except OSError as e:
+                    warn(f"swapon {what}: {e.strerror}")
+                    ok = False
+        if not ok and check:
+            error(f"Can't activate swap on {what}")
+        if ok and self.state:
+            subsystem = {"swapd": "swapD", "zram": "Zram"}.get(tag, "swapFC")
+            self.state.add(
+                what,
+                subsystem,
+                f"{self.unit_dir}/{unit_name}",
+                priority=priority,
+                **details,
+            )
+        return ok
+
+    def start_transient(
+        self,
+        unit_name: str,
+        what: str,
+        priority: Optional[int],
+        options: Optional[str],
+    ) -> bool:
+        properties = ["Description", "s", f"Swap {what}", "What", "s", what]
+        if priority is not None:
+            properties += ["Priority", "i", str(priority)]
+        if options:
+            properties += ["Options", "s", options]
+        ret_code = subprocess.run(
+            [
+                "busctl",
+                "call",
+                "--quiet",
+                "org.freedesktop.systemd1",
+                "/org/freedesktop/systemd1",
+                "org.freedesktop.systemd1.Manager",
+                "StartTransientUnit",
+                "ssa(sv)a(sa(sv))",
+                unit_name,
+                "fail",
+                str(len(properties) // 3),
+                *properties,
+                "0",
+            ]
+        ).returncode
+        if ret_code != 0:
+            return False
+        # The call only queues a job, wait for the swap to show up.
+        deadline = time.monotonic() + self.activation_timeout
+        while what not in get_active_swaps():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def enable(
+        self,
+        what: str,
+        tag: str,
+        priority: Optional[int] = None,
+        options: Optional[str] = None,
+        **details,
+    ) -> str:
+        unit_name = self.add(what, tag, priority, options, **details)
+        self.reload()
+        self.start(unit_name, check=True)
+        return unit_name
+
+    def forget(self, what: str) -> None:
+        if self.state:
+            self.state.remove(what)
+
+
+class SparePool:
+    """Inactive, already mkswap'ed chunks, so that expanding only costs a swapon."""
+
+    # Seconds without allocations before the pool is refilled.
+    quiet_time = 10
+
+    def __init__(self, swapfc: SwapFc, count: int):
+        self.swapfc = swapfc
+        self.count = count
+        self.spares = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.refill, daemon=True)
+
+    def start(self) -> None:
+        self.wakeup.set()
+        self.thread.start()
+
+    def take(self, path: str) -> bool:
+        with self.lock:
+            if not self.spares:
+                return False
+            spare = self.spares.pop()
+            try:
+                os.rename(spare, path)
+            except OSError as e:
+                warn(f"swapFC: can't use spare chunk {spare}: {e.strerror}")
+                force_remove(spare)
+                return False
+        self.wakeup.set()
+        return True
+
+    def put(self, path: str) -> bool:
+        """Recycle a swapped off chunk file as a spare."""
+        with self.lock:
+            if len(self.spares) >= self.count:
+                return False
+            spare = self.spare_path()
+            try:
+                os.rename(path, spare)
+            except OSError as e:
+                warn(f"swapFC: can't keep {path} as spare: {e.strerror}")
+                return False
+            self.spares.append(spare)
+        info(f"swapFC: chunk {os.path.basename(path)} kept as spare")
+        return True
+
+    def spare_path(self) -> str:
+        n = 1
+        while os.path.join(self.swapfc.swapfc_path, f"spare.{n}") in self.spares:
+            n += 1
+        return os.path.join(self.swapfc.swapfc_path, f"spare.{n}")
+
+    def wanted(self) -> bool:
+        with self.lock:
+            count = len(self.spares)
+        return (
+            count < self.count
+            and self.swapfc.allocated + count < self.swapfc.swapfc_max_count
+        )
+
+    def refill(self) -> None:
+        new_path = os.path.join(self.swapfc.swapfc_path, ".spare.new")
+        while not sigterm_event.is_set():
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.wanted() and not sigterm_event.is_set():
+                idle = time.monotonic() - self.swapfc.last_allocation
+                if idle < self.quiet_time:
+                    sigterm_event.wait(self.quiet_time - idle)
+                    continue
+                # Prepare spares as large as the next chunks would be.
+                size = self.swapfc.chunk_size_for(
+                    self.swapfc.allocated + len(self.spares)
+                )
+                if not self.swapfc.has_enough_space(self.swapfc.swapfc_path, size):
+                    debug("swapFC: not enough space for spare chunks")
+                    break
+                try:
+                    self.swapfc.prepare_swapfile(
+                        new_path, f"SWAP_{self.swapfc.fs_type}_spare", size
+                    )
+                    with self.lock:
+                        spare = self.spare_path()
+                        os.rename(new_path, spare)
+                        self.spares.append(spare)
+                except OSError as e:
+                    warn(f"swapFC: can't prepare spare chunk: {e}")
+                    force_remove(new_path)
+                    break
+                info(f"swapFC: spare chunk ready ({len(self.spares)}/{self.count})")
+
+
+class SwapChunk:
+    __slots__ = ("number", "swapfile", "size", "priority", "unit_path")
+
+    def __init__(
+        self, number: int, swapfile: str, size: int, priority: int, unit_path: str
+    ):
+        self.number = number
+        self.swapfile = swapfile
+        self.size = size
+        self.priority = priority
+        self.unit_path = unit_path
+
+
+class ChunkDrainer(threading.Thread):
+    """Swap off a chunk in the background: draining -> done, cancelled or failed."""
+
+    def __init__(self, chunk: SwapChunk):
+        super().__init__(daemon=True)
+        self.chunk = chunk
+        self.state = "draining"
+        self.cancelled = False
+        self.process = None
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.duration = 0.0
+
+    def run(self) -> None:
+        with self.lock:
+            if self.cancelled:
+                self.state = "cancelled"
+                return
+            try:
+                self.process = subprocess.Popen(["swapoff", self.chunk.swapfile])
+            except OSError as e:
+                warn(f"swapFC: can't run swapoff: {e.strerror}")
+                self.state = "failed"
+                return
+        with span("swapfc_swapoff", chunk=self.chunk.number):
+            ret_code = self.process.wait()
+        with self.lock:
+            self.duration = time.monotonic() - self.start_time
+            if ret_code == 0:
+                self.state = "done"
+            elif self.cancelled:
+                self.state = "cancelled"
+            else:
+                self.state = "failed"
+
+    def cancel(self) -> None:
+        # swapoff(2) gives up with EINTR on a signal and puts the chunk back in use.
+        with self.lock:
+            self.cancelled = True
+            if self.process and self.process.poll() is None:
+                self.process.send_signal(signal.SIGTERM)
+
+
+class PeriodicTask(threading.Thread, abc.ABC):
+    """Run tick() every interval seconds until SIGTERM."""
+
+    def __init__(self, name: str, interval: float):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+
+    def run(self) -> None:
+        while not sigterm_event.wait(self.interval):
+            try:
+                self.tick()
+            except OSError as e:
+                warn(f"{self.name}: {e}")
+
+    @abc.abstractmethod
+    def tick(self) -> None:
+        pass
+
+
+class ZramScheduler(PeriodicTask):
+    """Write back and recompress zram pages that stayed idle since the last run."""
+
+    def __init__(
+        self,
+        sysfs: str,
+        writeback_interval: int = 0,
+        threshold: int = 100,
+        recomp_interval: int = 0,
+        recomp_type: str = "idle",
+    ):
+        name = os.path.basename(sysfs)
+        intervals = [i for i in [writeback_interval, recomp_interval] if i > 0]
+        super().__init__(f"Zram: {name}", min(intervals + [60]))
+        self.sysfs = sysfs
+        self.writeback_interval = writeback_interval
+        self.threshold = threshold
+        self.recomp_interval = recomp_interval
+        self.recomp_type = recomp_type
+        self.stats_path = f"{WORK_DIR}/zram/{name}.json"
+        self.last_writeback = self.last_recomp = time.monotonic()
+        write("all", f"{self.sysfs}/idle")
+
+    def mm_stat(self) -> Tuple[int, int]:
+        """Return orig_data_size and compr_data_size."""
+        orig_data_size, compr_data_size = read(f"{self.sysfs}/mm_stat").split()[:2]
+        return int(orig_data_size), int(compr_data_size)
+
+    def writeback(self, mode: str) -> None:
+        before = int(read(f"{self.sysfs}/bd_stat").split()[0])
+        write(mode, f"{self.sysfs}/writeback")
+        written = int(read(f"{self.sysfs}/bd_stat").split()[0]) - before
+        info(f"{self.name}: {mode} pages, {written * 4096} byte(s) written back")
+
+    def recompress(self) -> None:
+        before = self.mm_stat()
+        write(f"type={self.recomp_type}", f"{self.sysfs}/recompress")
+        after = self.mm_stat()
+        saved = before[1] - after[1]
+        info(f"{self.name}: {self.recomp_type} pages, {saved} byte(s) saved")
+        with open(f"{self.stats_path}.new", "w") as f:
+            json.dump({"time": time.time(), "before": before, "after": after}, f)
+        os.replace(f"{self.stats_path}.new", self.stats_path)
+
+    def tick(self) -> None:
+        now = time.monotonic()
+        ran = False
+        if self.recomp_interval and now - self.last_recomp >= self.recomp_interval:
+            self.recompress()
+            self.last_recomp = now
+            ran = True
+        if self.writeback_interval:
+            orig_data_size = self.mm_stat()[0]
+            disksize = int(read(f"{self.sysfs}/disksize"))
+            if orig_data_size * 100 > self.threshold * disksize:
+                self.writeback("huge")
+                self.writeback("idle")
+            elif now - self.last_writeback >= self.writeback_interval:
+                self.writeback("huge")
+                self.writeback("idle")
+                self.last_writeback = now
+                ran = True
+        if ran:
+            write("all", f"{self.sysfs}/idle")
+
+
+class ZswapController(PeriodicTask):
+    """Grow max_pool_percent while zswap compresses well, shrink it otherwise."""
+
+    step = 5
+    good_ratio = 2.0
+    poor_ratio = 1.5
+    # Ticks without limit hits before the shrinker and accept threshold are restored.
+    calm_ticks = 10
+
+    def __init__(self, interval: int, min_percent: int, max_percent: int):
+        super().__init__("Zswap: pool controller", interval)
+        self.min_percent = min_percent
+        self.max_percent = max_percent
+        self.percent = int(read(f"{ZSWAP_M_P}/max_pool_percent"))
+        self.defaults = {}
+        for param in ["accept_threshold_percent", "shrinker_enabled"]:
+            if os.path.isfile(f"{ZSWAP_M_P}/{param}"):
+                self.defaults[param] = read(f"{ZSWAP_M_P}/{param}").strip()
+        self.calm = 0
+        self.last = self.counters()
+
+    @staticmethod
+    def counters() -> Dict[str, int]:
+        counters = {}
+        for file in os.listdir(ZSWAP_D):
+            try:
+                counters[file] = int(read(f"{ZSWAP_D}/{file}"))
+            except ValueError:
+                pass
+        # Unlike stored_pages, a counter of every page stored (5.19+).
+        with open(PROC_VMSTAT) as f:
+            for line in f:
+                if line.startswith("zswpout "):
+                    counters["zswpout"] = int(line.split()[1])
+        return counters
+
+    def set_percent(self, percent: int, reason: str) -> None:
+        percent = max(self.min_percent, min(percent, self.max_percent))
+        if percent != self.percent:
+            info(f"{self.name}: max_pool_percent {self.percent} -> {percent}, {reason}")
+            write(str(percent), f"{ZSWAP_M_P}/max_pool_percent")
+            self.percent = percent
+
+    def set_param(self, param: str, value: str) -> None:
+        if param in self.defaults and read(f"{ZSWAP_M_P}/{param}").strip() != value:
+            info(f"{self.name}: {param}={value}")
+            write(value, f"{ZSWAP_M_P}/{param}")
+
+    def tick(self) -> None:
+        counters = self.counters()
+        delta = {k: v - self.last.get(k, 0) for k, v in counters.items()}
+        self.last = counters
+        ratio = 0.0
+        if counters.get("pool_total_size", 0) > 0:
+            stored_bytes = counters.get("stored_pages", 0) * PAGE_SIZE
+            ratio = stored_bytes / counters["pool_total_size"]
+        rejects = sum(v for k, v in delta.items() if k.startswith("reject_"))
+        if "zswpout" in delta:
+            stores = delta["zswpout"]
+        else:
+            stores = max(delta.get("stored_pages", 0), 0) + delta.get(
+                "written_back_pages", 0
+            )
+        limit_hit = delta.get("pool_limit_hit", 0) > 0
+        # Reclaim and allocation failures of a full pool ask for more room, not less.
+        bad_rejects = rejects
+        if limit_hit:
+            bad_rejects = delta.get("reject_compress_poor", 0)
+        reject_rate = bad_rejects / (rejects + stores) if bad_rejects else 0.0
+        debug(
+            f"{self.name}: ratio {ratio:.2f}, reject rate {reject_rate:.2f}, "
+            f"limit hits {delta.get('pool_limit_hit', 0)}"
+        )
+        if ratio and ratio < self.poor_ratio or reject_rate > 0.5:
+            self.set_percent(
+                self.percent - self.step,
+                f"ratio {ratio:.2f}, reject rate {reject_rate:.2f}",
+            )
+        elif limit_hit and ratio >= self.good_ratio:
+            self.set_percent(self.percent + self.step, f"ratio {ratio:.2f}")
+        if limit_hit and self.percent >= self.max_percent:
+            self.calm = 0
+            self.set_param("shrinker_enabled", "Y")
+            self.set_param("accept_threshold_percent", "80")
+        elif not limit_hit:
+            self.calm += 1
+            if self.calm == self.calm_ticks:
+                for param, value in self.defaults.items():
+                    self.set_param(param, value)
+
+
+class MetricsServer(threading.Thread):
+    """Answer HTTP requests on a unix socket with the current metrics."""
+
+    def __init__(self, path: str, mode: int):
+        super().__init__(name="Metrics: server", daemon=True)
+        force_remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(path)
+            # Connecting needs write permission, bind() leaves that to the umask.
+            os.chmod(path, mode)
+            self.sock.listen(8)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def run(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError as e:
+                # Ex. out of file descriptors, retry without spinning.
+                warn(f"{self.name}: {e}")
+                time.sleep(1)
+                continue
+            with conn:
+                try:
+                    conn.settimeout(5)
+                    # Whatever is asked for, there is only one document.
+                    conn.recv(4096)
+                    body = METRICS.render().encode()
+                    conn.sendall(
+                        b"HTTP/1.0 200 OK\r\n"
+                        b"Content-Type: text/plain; version=0.0.4\r\n"
+                        + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                        + body
+                    )
+                except OSError as e:
+                    debug(f"{self.name}: {e}")
+
+
+class MetricsTextfile(PeriodicTask):
+    """Write the metrics to a file for the node exporter textfile collector."""
+
+    def __init__(self, path: str, interval: int):
+        super().__init__("Metrics: textfile", interval)
+        self.path = path
+
+    def tick(self) -> None:
+        with open(f"{self.path}.new", "w") as f:
+            f.write(METRICS.render())
+        os.replace(f"{self.path}.new", self.path)
+
+
+def collect_zram_metrics() -> None:
+    for name in ["orig_data_size", "compr_data_size", "mem_used_total"]:
+        METRICS.reset(f"zram_{name}_bytes")
+    for name in ["same_pages", "huge_pages"]:
+        METRICS.reset(f"zram_{name}")
+    for device in zram_status(get_active_swaps()):
+        for name in ["orig_data_size", "compr_data_size", "mem_used_total"]:
+            METRICS.set(f"zram_{name}_bytes", device[name], device=device["name"])
+        for name in ["same_pages", "huge_pages"]:
+            if device[name] is not None:
+                METRICS.set(f"zram_{name}", device[name], device=device["name"])
+
+
+def collect_zswap_metrics() -> None:
+    for file in os.listdir(ZSWAP_D):
+        try:
+            value = int(read(f"{ZSWAP_D}/{file}"))
+        except ValueError:
+            continue
+        if file in ["pool_total_size", "stored_pages", "same_filled_pages"]:
+            METRICS.describe(f"zswap_{file}", "gauge", f"Zswap {file}.")
+            METRICS.set(f"zswap_{file}", value)
+        else:
+            METRICS.describe(f"zswap_{file}_total", "counter", f"Zswap {file}.")
+            METRICS.set(f"zswap_{file}_total", value)
+
+
+METRICS.describe("startup_seconds", "gauge", "Time from start to READY.")
+METRICS.describe("swapfc_chunks", "gauge", "Active swapFC chunks.")
+METRICS.describe("swapfc_chunk_size_bytes", "gauge", "Size of swapFC chunks.")
+METRICS.describe("swapfc_allocations_total", "counter", "Allocated swapFC chunks.")
+METRICS.describe("swapfc_deallocations_total", "counter", "Freed swapFC chunks.")
+METRICS.describe(
+    "swapfc_adoptions_total", "counter", "swapFC chunks taken over on start."
+)
+METRICS.describe(
+    "swapfc_enospc_total", "counter", "swapFC allocations skipped for lack of space."
+)
+METRICS.describe(
+    "swapfc_polling_rate_seconds", "gauge", "swapFC polling rate, backed off on ENOSPC."
+)
+METRICS.describe(
+    "phase_duration_seconds", "histogram", "Time spent setting up or freeing swap."
+)
+METRICS.describe("zram_orig_data_size_bytes", "gauge", "Uncompressed zram data.")
+METRICS.describe("zram_compr_data_size_bytes", "gauge", "Compressed zram data.")
+METRICS.describe("zram_mem_used_total_bytes", "gauge", "Memory used by zram.")
+METRICS.describe("zram_same_pages", "gauge", "Same filled zram pages.")
+METRICS.describe("zram_huge_pages", "gauge", "Incompressible zram pages.")
 
 
 class SwapFc:
-    def __init__(self, config: Config, sem: sysv_ipc.Semaphore):
+    def __init__(
+        self, config: Config, sem: sysv_ipc.Semaphore, activator: SwapActivator
+    ):
         self.assign_config(config)
         self.sem = sem
+        self.activator = activator
         # Validate swapfc_frequency due to possible issues caused if set incorrectly.
         if not 1 <= self.swapfc_frequency <= 24 * 60 * 60:
             warn(
@@ -162,6 +1412,8 @@ class SwapFc:
             )
             self.swapfc_frequency = 1
         self.polling_rate = self.swapfc_frequency
+        self.psi = self.open_psi() if self.swapfc_psi_enabled else None
+        self.cgroups = self.open_cgroups()
         systemd.daemon.notify("STATUS=Monitoring memory status...")
         # Create parent directories for swapfc_path.
         makedirs(os.path.dirname(self.swapfc_path))
@@ -185,15 +1437,24 @@ class SwapFc:
                 )
         else:
             makedirs(self.swapfc_path)
-        self.chunk_size = int(
-            subprocess.run(
-                ["numfmt", "--to=none", "--from=iec", self.swapfc_chunk_size],
-                check=True,
-                text=True,
-                stdout=subprocess.PIPE,
-            ).stdout
-        )
+        self.chunk_size = self.parse_size(self.swapfc_chunk_size)
+        if self.chunk_size % (1024 * 1024):
+            warn(
+                "swapFC: chunk size not set to multiple of 1 MiB, current chunk "
+                f"size = {self.chunk_size} byte(s)"
+            )
+        self.chunk_size_max = self.parse_size(self.swapfc_chunk_size_max)
+        if self.chunk_size_max < self.chunk_size:
+            warn("swapfc_chunk_size_max is less than swapfc_chunk_size, ignored")
+            self.chunk_size_max = self.chunk_size
+        if self.swapfc_chunk_growth < 1:
+            warn("swapfc_chunk_growth must be at least 1, reset to 1")
+            self.swapfc_chunk_growth = 1
         self.block_size = os.statvfs(self.swapfc_path).f_bsize
+        self.swap_options = "discard" if not self.swapfc_force_preallocated else None
+        self.allocator = ChunkAllocator(
+            self.swapfc_alloc_strategy, self.fs_type, self.swapfc_path
+        )
         if self.fs_type == "btrfs":
             # If btrfs supports regular swap files (kernel version 5+), force disable
             # COW to avoid data corruption. If it doesn't, use the old swap-through-loop
@@ -206,12 +1467,25 @@ class SwapFc:
             warn("swapfc_max_count must be in range 1..32, reset to 1")
             self.swapfc_max_count = 1
         makedirs(f"{WORK_DIR}/swapfc")
-        self.allocated = 0
-        for _ in range(self.swapfc_min_count):
+        if self.swapfc_policy not in ["threshold", "predictive"]:
+            warn(f"swapfc_policy {self.swapfc_policy} is unknown, reset to threshold")
+            self.swapfc_policy = "threshold"
+        self.chunks = {}
+        METRICS.add_collector(self.collect_metrics)
+        self.drainer = None
+        self.last_allocation = 0.0
+        self.create_time = 1.0
+        self.spares = None
+        if self.swapfc_spare_count > 0:
+            self.spares = SparePool(self, self.swapfc_spare_count)
+        if self.swapfc_adopt:
+            with span("swapfc_adopt"):
+                self.adopt()
+        for _ in range(self.swapfc_min_count - self.allocated):
             self.create_swapfile()
 
     def run(self) -> None:
-        systemd.daemon.notify("READY=1")
+        notify_ready()
         if self.allocated == 0:
             memory_usage = round(
                 RAM_SIZE * (100 - self.swapfc_free_ram_perc) / (1024 * 1024 * 100)
@@ -220,17 +1494,25 @@ class SwapFc:
                 f"swapFC: on-demand swap activation at >{memory_usage} MiB memory usage"
             )
         signal.signal(signal.SIGTERM, sigterm_handler)
+        if self.spares:
+            self.spares.start()
         while True:
             self.sem.release()
-            sigterm_event.wait(self.polling_rate)
+            self.wait()
             if sigterm_event.is_set():
                 break
             try:
                 self.sem.acquire(0)
             except sysv_ipc.BusyError:
                 break
+            sample = MEMINFO.sample()
+            shortage = self.cgroup_shortage() if self.cgroups else None
+            if self.drainer and self.check_drain(sample):
+                continue
+            if self.swapfc_policy == "predictive" and self.allocate_ahead(sample):
+                continue
             if self.allocated == 0:
-                curr_free_ram_perc = self.get_free_ram_perc()
+                curr_free_ram_perc = sample.free_ram_perc()
                 if curr_free_ram_perc < self.swapfc_free_ram_perc:
                     info(
                         f"swapFC: free RAM ({curr_free_ram_perc}%) less than minimum "
@@ -238,8 +1520,11 @@ class SwapFc:
                         "first chunk"
                     )
                     self.create_swapfile()
+                elif shortage:
+                    info(f"swapFC: {shortage} - allocate first chunk")
+                    self.create_swapfile()
                 continue
-            curr_free_swap_perc = self.get_free_swap_perc()
+            curr_free_swap_perc = sample.free_swap_perc()
             if (
                 curr_free_swap_perc < self.swapfc_free_swap_perc
                 and self.allocated < self.swapfc_max_count
@@ -247,19 +1532,208 @@ class SwapFc:
                 info(
                     f"swapFC: free swap ({curr_free_swap_perc}%) less than minimum "
                     f"desired free swap ({self.swapfc_free_swap_perc}%) - allocate "
-                    f"chunk #{self.allocated + 1}"
+                    f"chunk #{self.next_chunk_number()}"
                 )
                 self.create_swapfile()
                 continue
-            if self.allocated <= max(self.swapfc_min_count, 2):
+            if self.allocated <= max(self.swapfc_min_count, 2) or self.drainer:
+                continue
+            # The cgroup may need the swap any moment.
+            if shortage:
+                continue
+            if self.swapfc_policy == "predictive" and MEMINFO.rate("swap_used") > 0:
                 continue
             if curr_free_swap_perc > self.swapfc_remove_free_swap_perc:
+                chunk = self.pick_chunk_to_free(sample)
+                if chunk is None:
+                    continue
                 info(
                     f"swapFC: free swap ({curr_free_swap_perc}%) more than maximum "
                     f"desired free swap ({self.swapfc_remove_free_swap_perc}%) - free "
-                    f"up chunk #{self.allocated}"
+                    f"up chunk #{chunk.number}"
                 )
-                self.destroy_swapfile()
+                self.destroy_swapfile(chunk)
+        if self.drainer:
+            self.drainer.cancel()
+
+    @property
+    def allocated(self) -> int:
+        return len(self.chunks)
+
+    def next_chunk_number(self) -> int:
+        number = 1
+        while number in self.chunks:
+            number += 1
+        return number
+
+    def chunk_size_for(self, count: int) -> int:
+        """Size of the chunk added while count chunks are allocated."""
+        if self.swapfc_chunk_growth == 1:
+            return self.chunk_size
+        size = min(
+            self.chunk_size * self.swapfc_chunk_growth**count, self.chunk_size_max
+        )
+        return int(size) - int(size) % PAGE_SIZE
+
+    def pick_chunk_to_free(self, sample: MemSample) -> Optional[SwapChunk]:
+        """Pick the chunk with the fewest used pages, the largest one among equals.
+
+        swapoff has to read every used page back, so this is the cheapest chunk to
+        free. Chunks whose removal would drop free swap below the threshold are
+        skipped.
+        """
+        swaps = get_active_swaps()
+
+        def used(chunk: SwapChunk) -> int:
+            entry = swaps.get(chunk.swapfile)
+            return entry.used if entry else 0
+
+        chunks = sorted(
+            self.chunks.values(),
+            key=lambda c: (used(c), -c.size, -c.number),
+        )
+        for chunk in chunks:
+            swap_total = sample.swap_total - chunk.size
+            swap_free = sample.swap_free - chunk.size + used(chunk)
+            if swap_free * 100 >= self.swapfc_free_swap_perc * max(swap_total, 1):
+                return chunk
+        return None
+
+    def allocate_ahead(self, sample: MemSample) -> bool:
+        """Allocate as many chunks as needed to last until the next check.
+
+        The consumption rate comes from the recent samples and the time needed per
+        chunk from the previous allocations. Returns False if the threshold policy
+        should decide instead.
+        """
+        delay = self.next_check_delay()
+        if self.allocated == 0:
+            rate = -MEMINFO.rate("mem_free")
+            horizon = delay + self.create_time
+            free_ram = (sample.mem_free - rate * horizon) * 100 / sample.mem_total
+            if rate <= 0 or free_ram >= self.swapfc_free_ram_perc:
+                return False
+            info(
+                f"swapFC: free RAM drops by {rate / (1024 * 1024):.0f} MiB/s, below "
+                f"{self.swapfc_free_ram_perc}% in {horizon:.1f}s - allocate first chunk"
+            )
+            self.create_swapfile()
+            return True
+        rate = MEMINFO.rate("swap_used")
+        if rate <= 0:
+            return False
+        chunks = 0
+        added = 0
+        while self.allocated + chunks < self.swapfc_max_count:
+            horizon = delay + (chunks + 1) * self.create_time
+            free_swap = sample.swap_free + added - rate * horizon
+            if free_swap * 100 >= self.swapfc_free_swap_perc * (
+                sample.swap_total + added
+            ):
+                break
+            added += self.chunk_size_for(self.allocated + chunks)
+            chunks += 1
+        if not chunks:
+            return False
+        info(
+            f"swapFC: swap usage grows by {rate / (1024 * 1024):.0f} MiB/s - allocate "
+            f"{chunks} chunk(s) ahead"
+        )
+        for _ in range(chunks):
+            if not self.create_swapfile():
+                break
+        return True
+
+    def next_check_delay(self) -> float:
+        if self.psi is None or self.polling_rate > self.swapfc_frequency:
+            return self.polling_rate
+        return self.swapfc_psi_window_us / 1000000
+
+    def wait(self) -> None:
+        # While ENOSPC backs off, poll at the doubled rate instead of retrying the
+        # allocation on every stall event.
+        if self.psi is None or self.polling_rate > self.swapfc_frequency:
+            sigterm_event.wait(self.polling_rate)
+            return
+        # Memory pressure is what makes us allocate, so mostly sleep until a stall
+        # trigger fires. Still sample now and then for the free RAM threshold and
+        # the predictive policy, and keep polling while chunks may be freed.
+        timeout = self.polling_rate * 4
+        if self.allocated > max(self.swapfc_min_count, 2):
+            timeout = self.polling_rate
+        self.psi.wait(timeout)
+
+    def open_cgroups(self) -> List[CgroupMemory]:
+        cgroups = []
+        for cgroup in self.swapfc_cgroups:
+            path = f"{CGROUP_ROOT}/{cgroup.strip('/')}"
+            try:
+                cgroups.append(CgroupMemory(path))
+            except (OSError, ValueError) as e:
+                warn(f"swapFC: can't watch memory of {path}: {e}")
+        return cgroups
+
+    def cgroup_shortage(self) -> Optional[str]:
+        """Check every watched cgroup, describe the ones short of memory."""
+        reasons = []
+        for cgroup in list(self.cgroups):
+            try:
+                reason = cgroup.shortage(self.swapfc_free_ram_perc)
+            except (OSError, ValueError) as e:
+                warn(f"swapFC: stop watching {cgroup.path}: {e}")
+                cgroup.close()
+                self.cgroups.remove(cgroup)
+                continue
+            if reason:
+                reasons.append(f"{cgroup.path} {reason}")
+        return "; ".join(reasons) or None
+
+    def open_psi(self) -> Optional[PsiMonitor]:
+        if not 500000 <= self.swapfc_psi_window_us <= 10000000:
+            warn(
+                "swapfc_psi_window_us must be in range of 500000..10000000: "
+                f"{self.swapfc_psi_window_us} - set to 1000000"
+            )
+            self.swapfc_psi_window_us = 1000000
+        if not 0 < self.swapfc_psi_stall_us <= self.swapfc_psi_window_us:
+            warn(
+                "swapfc_psi_stall_us must be in range of 1..swapfc_psi_window_us: "
+                f"{self.swapfc_psi_stall_us} - set to 100000"
+            )
+            self.swapfc_psi_stall_us = min(100000, self.swapfc_psi_window_us)
+        if not os.path.isfile(PSI_MEMORY):
+            info("swapFC: PSI is not supported by the kernel, fall back to polling")
+            return None
+        psi = PsiMonitor(self.swapfc_psi_stall_us, self.swapfc_psi_window_us)
+        try:
+            psi.add_trigger(PSI_MEMORY)
+        except OSError as e:
+            warn(
+                f"swapFC: can't register PSI trigger: {e.strerror}, fall back to polling"
+            )
+            return None
+        for cgroup in self.swapfc_cgroups:
+            path = f"{CGROUP_ROOT}/{cgroup.strip('/')}/memory.pressure"
+            try:
+                psi.add_trigger(path)
+            except OSError as e:
+                warn(f"swapFC: can't register PSI trigger on {path}: {e.strerror}")
+        info(
+            f"swapFC: waiting for memory stalls >{self.swapfc_psi_stall_us}us per "
+            f"{self.swapfc_psi_window_us}us"
+        )
+        return psi
+
+    @staticmethod
+    def parse_size(size: str) -> int:
+        """Parse sizes like numfmt --from=iec, e.g. 512M or 1.5G."""
+        match = re.fullmatch(r"\s*(\d+\.?\d*|\.\d+)([KMGTPEZY]?)\s*", size)
+        if not match:
+            error(f"swapFC: invalid size: {size}")
+        number, unit = match.groups()
+        power = "KMGTPEZY".index(unit) + 1 if unit else 0
+        # Rounded up, like numfmt does.
+        return math.ceil(float(number) * 1024**power)
 
     def get_fs_type(self) -> Tuple[str, bool]:
         subvolume = False
@@ -270,30 +1744,19 @@ class SwapFc:
             path = os.path.dirname(self.swapfc_path)
         else:
             error("swapfc_path is invalid")
-        output = subprocess.run(
-            ["df", path, "--output=fstype"],
-            check=True,
-            text=True,
-            stdout=subprocess.PIPE,
-        ).stdout
-        fs_type = output.splitlines()[1]
-        if fs_type == "-":
-            ret_code = subprocess.run(
-                ["btrfs", "subvolume", "show", path],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            ).returncode
-            if ret_code == 0:
-                fs_type = "btrfs"
-                if path == self.swapfc_path:
-                    subvolume = True
-            else:
-                error("swapfc_path is located on an unknown filesystem")
+        fs_type = get_fs_type(path)
+        if fs_type == "btrfs" and path == self.swapfc_path:
+            subvolume = os.stat(path).st_ino == BTRFS_FIRST_FREE_OBJECTID
         return fs_type, subvolume
 
     def assign_config(self, config: Config) -> None:
         yn = lambda x: config.get(x, bool)
+        self.swapfc_adopt = yn("swapfc_adopt")
+        self.swapfc_alloc_strategy = config.get("swapfc_alloc_strategy")
+        self.swapfc_cgroups = config.get("swapfc_cgroups").split()
+        self.swapfc_chunk_growth = config.get("swapfc_chunk_growth", float)
         self.swapfc_chunk_size = config.get("swapfc_chunk_size")
+        self.swapfc_chunk_size_max = config.get("swapfc_chunk_size_max")
         self.swapfc_directio = yn("swapfc_directio")
         self.swapfc_force_preallocated = yn("swapfc_force_preallocated")
         self.swapfc_force_use_loop = yn("swapfc_force_use_loop")
@@ -304,56 +1767,164 @@ class SwapFc:
         self.swapfc_min_count = config.get("swapfc_min_count", int)
         self.swapfc_nocow = yn("swapfc_nocow")
         self.swapfc_path = config.get("swapfc_path").rstrip("/")
+        self.swapfc_policy = config.get("swapfc_policy")
         self.swapfc_priority = config.get("swapfc_priority", int)
+        self.swapfc_psi_enabled = yn("swapfc_psi_enabled")
+        self.swapfc_psi_stall_us = config.get("swapfc_psi_stall_us", int)
+        self.swapfc_psi_window_us = config.get("swapfc_psi_window_us", int)
         self.swapfc_remove_free_swap_perc = config.get(
             "swapfc_remove_free_swap_perc", int
         )
+        self.swapfc_spare_count = config.get("swapfc_spare_count", int)
+
+    def adopt(self) -> None:
+        """Take over the chunks and spare files left behind by the last stop.
+
+        Chunks still active are checked and registered again, so that nothing is
+        swapped back in. Other files in swapfc_path are reused as spares if they
+        check out, and removed otherwise.
+        """
+        swapfc_path = os.path.realpath(self.swapfc_path)
+        state = self.activator.state
+        records = state.by_subsystem("swapFC") if state else {}
+        active_swaps = get_active_swaps()
+        adopted = set()
+        for what, record in sorted(records.items(), key=lambda r: r[1]["chunk"]):
+            number = record["chunk"]
+            if (
+                what not in active_swaps
+                or number in self.chunks
+                or os.path.dirname(record["file"]) != swapfc_path
+                or not self.check_swapfile(what, record["size"])
+            ):
+                warn(f"swapFC: can't adopt chunk #{number} ({what})")
+                if what in active_swaps:
+                    swapoff(record["unit"], "swapFC", what)
+                else:
+                    force_remove(record["unit"], verbose=True)
+                state.remove(what)
+                continue
+            unit_path = record["unit"]
+            if not os.path.isfile(unit_path):
+                unit_name = gen_swap_unit(
+                    what,
+                    f"swapfc_{number}",
+                    record["priority"],
+                    self.swap_options,
+                    self.activator.unit_dir,
+                )
+                unit_path = f"{self.activator.unit_dir}/{unit_name}"
+                record["unit"] = unit_path
+                state.save()
+            self.chunks[number] = SwapChunk(
+                number, what, record["size"], record["priority"], unit_path
+            )
+            adopted.add(record["file"])
+            info(f"swapFC: adopted chunk #{number} (size: {record['size']} byte(s))")
+            METRICS.inc("swapfc_adoptions_total")
+        # Spares first, so that renaming chunks into the pool doesn't replace them.
+        files = sorted(os.listdir(swapfc_path), key=lambda n: (n[0].isdigit(), n))
+        for file in files:
+            path = os.path.join(swapfc_path, file)
+            if path in adopted:
+                continue
+            if not (
+                self.spares and self.check_swapfile(path) and self.spares.put(path)
+            ):
+                force_remove(path, verbose=True)
+
+    def check_swapfile(self, path: str, size: Optional[int] = None) -> bool:
+        """Check that path holds a swap area, as large as size if given.
 
-    def create_swapfile(self) -> None:
-        if not self.has_enough_space(self.swapfc_path):
+        Also works for active swap files and loop devices, which are only read.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                actual_size = os.lseek(fd, 0, os.SEEK_END)
+                signature = os.pread(fd, 10, PAGE_SIZE - 10)
+            finally:
+                os.close(fd)
+            if self.fs_type == "btrfs" and self.swapfc_nocow and os.path.isfile(path):
+                if not get_nocow(path):
+                    return False
+        except OSError:
+            return False
+        if size is not None and actual_size != size:
+            return False
+        return signature == b"SWAPSPACE2" and actual_size >= 10 * PAGE_SIZE
+
+    def create_swapfile(self) -> bool:
+        number = self.next_chunk_number()
+        with span("swapfc_create", chunk=number):
+            return self.create_chunk(number)
+
+    def create_chunk(self, number: int) -> bool:
+        start_time = time.monotonic()
+        size = self.chunk_size_for(self.allocated)
+        path = os.path.join(self.swapfc_path, str(number))
+        spare = self.spares and self.spares.take(path)
+        if not spare and not self.has_enough_space(self.swapfc_path, size):
             warn("swapFC: ENOSPC")
+            METRICS.inc("swapfc_enospc_total")
             # Prevent spamming the journal.
             self.double_polling_rate()
             systemd.daemon.notify("STATUS=Not enough space for allocating chunk")
-            return
+            return False
         # In case we have adjusted the polling rate, reset it.
         self.reset_polling_rate()
         systemd.daemon.notify("STATUS=Allocating swap file...")
-        self.allocated += 1
-        info(
-            f"swapFC: allocating chunk {self.allocated} (size: {self.chunk_size} byte(s))..."
-        )
-        swapfile = self.prepare_swapfile(
-            os.path.join(self.swapfc_path, str(self.allocated))
-        )
-        mkswap_result = subprocess.run(
-            ["mkswap", "-L", f"SWAP_{self.fs_type}_{self.allocated}", swapfile],
-            stdout=subprocess.DEVNULL,
-        )
-        if mkswap_result.returncode:
-            error(f"swapFC: mkswap failed with code {mkswap_result.returncode}")
-        options = "discard" if not self.swapfc_force_preallocated else None
-        unit_name = gen_swap_unit(
+        self.last_allocation = time.monotonic()
+        if spare:
+            size = os.stat(path).st_size
+            info(
+                f"swapFC: activating spare chunk as chunk {number} (size: {size} "
+                "byte(s))"
+            )
+        else:
+            info(f"swapFC: allocating chunk {number} (size: {size} byte(s))...")
+            try:
+                self.prepare_swapfile(path, f"SWAP_{self.fs_type}_{number}", size)
+            except OSError as e:
+                error(f"swapFC: can't prepare {path}: {e.strerror}")
+        swapfile = path
+        if self.swapfc_force_use_loop:
+            with span("swapfc_losetup", chunk=number):
+                swapfile = self.losetup_w(path)
+        swapfile = os.path.realpath(swapfile)
+        # Priorities follow chunk numbers, so that numbers freed by shrinking are
+        # reused with the same priority.
+        priority = self.swapfc_priority - (number - 1)
+        unit_name = self.activator.enable(
             what=swapfile,
-            priority=self.swapfc_priority,
-            options=options,
-            tag=f"swapfc_{self.allocated}",
+            priority=priority,
+            options=self.swap_options,
+            tag=f"swapfc_{number}",
+            file=os.path.realpath(path),
+            loop=swapfile if swapfile != os.path.realpath(path) else None,
+            size=size,
+            chunk=number,
         )
-        self.swapfc_priority -= 1
-        subprocess.run(["systemctl", "daemon-reload"], check=True)
-        subprocess.run(["systemctl", "start", unit_name], check=True)
+        unit_path = f"{self.activator.unit_dir}/{unit_name}"
+        self.chunks[number] = SwapChunk(number, swapfile, size, priority, unit_path)
         mode = os.stat(swapfile).st_mode
         if stat.S_ISBLK(mode):
-            subprocess.run(["losetup", "-d", swapfile])
+            with span("swapfc_losetup", chunk=number):
+                subprocess.run(["losetup", "-d", swapfile])
+        # Smoothed, the predictive policy plans with it.
+        duration = time.monotonic() - start_time
+        self.create_time = (self.create_time + duration) / 2
+        METRICS.inc("swapfc_allocations_total")
         systemd.daemon.notify("STATUS=Monitoring memory status...")
+        return True
 
-    def has_enough_space(self, path: str) -> bool:
+    def has_enough_space(self, path: str, size: int) -> bool:
         # Check free space to avoid problems on swap IO + ENOSPC.
         free_blocks = os.statvfs(path).f_bavail
         free_bytes = free_blocks * self.block_size
         # Also try leaving some free space.
-        free_bytes -= self.chunk_size
-        return free_bytes >= self.chunk_size
+        free_bytes -= size
+        return free_bytes >= size
 
     def double_polling_rate(self) -> None:
         new_rate = self.polling_rate * 2
@@ -368,26 +1939,17 @@ class SwapFc:
             self.polling_rate = self.swapfc_frequency
             info(f"swapFC: polling rate reset to {self.polling_rate}s")
 
-    def prepare_swapfile(self, path: str) -> str:
+    def prepare_swapfile(self, path: str, label: str, size: int) -> None:
         # Delete file if it already exists.
         force_remove(path)
         os.mknod(path)
         if self.fs_type == "btrfs" and self.swapfc_nocow:
-            subprocess.run(["chattr", "+C", path], check=True)
-        zeros = b"\x00" * 1024 * 1024
-        with open(path, "wb") as swapfile:
-            for _ in range(round(self.chunk_size / (1024 * 1024))):
-                swapfile.write(zeros)
-                swapfile.flush()
-            remaining_bytes_to_zero_out = self.chunk_size % (1024 * 1024)
-            if remaining_bytes_to_zero_out:
-                warn(
-                    "swapFC: chunk size not set to multiple of 1 MiB, current chunk "
-                    f"size = {self.chunk_size} byte(s)"
-                )
-                swapfile.write(b"\x00" * remaining_bytes_to_zero_out)
-                swapfile.flush()
-        return path if not self.swapfc_force_use_loop else self.losetup_w(path)
+            with span("swapfc_nocow", path=path):
+                set_nocow(path)
+        with span("swapfc_fill", path=path, strategy=self.allocator.strategy):
+            self.allocator.allocate(path, size)
+        with span("swapfc_mkswap", path=path):
+            mkswap(path, label)
 
     def losetup_w(self, path: str) -> str:
         directio = "on" if self.swapfc_directio else "off"
@@ -402,35 +1964,69 @@ class SwapFc:
         os.remove(path)
         return file
 
-    def destroy_swapfile(self) -> None:
+    def destroy_swapfile(self, chunk: SwapChunk) -> None:
         systemd.daemon.notify("STATUS=Deallocating swap file...")
-        for unit_path in find_swap_units():
-            content = None
-            with open(unit_path) as f:
-                content = f.read()
-            if f"swapfc_{self.allocated}" in content:
-                dev = get_what_from_swap_unit(unit_path)
-                unit_name = os.path.basename(unit_path)
-                ret_code = subprocess.run(["systemctl", "stop", unit_name]).returncode
-                if ret_code != 0:
-                    subprocess.run(["swapoff", dev], check=True)
-                force_remove(unit_path, verbose=True)
-                if os.path.isfile(dev):
-                    force_remove(dev)
-                break
-        self.allocated -= 1
+        self.drainer = ChunkDrainer(chunk)
+        self.drainer.start()
+
+    def check_drain(self, sample: MemSample) -> bool:
+        """Advance the state of the running drain, return True if it was cancelled."""
+        chunk = self.drainer.chunk
+        if self.drainer.state == "draining":
+            if self.drainer.cancelled:
+                return True
+            curr_free_swap_perc = sample.free_swap_perc()
+            if curr_free_swap_perc >= self.swapfc_free_swap_perc:
+                return False
+            info(
+                f"swapFC: free swap ({curr_free_swap_perc}%) less than minimum desired "
+                f"free swap ({self.swapfc_free_swap_perc}%) - cancel freeing up chunk "
+                f"#{chunk.number}"
+            )
+            self.drainer.cancel()
+            return True
+        self.drainer.join()
+        drainer, self.drainer = self.drainer, None
         systemd.daemon.notify("STATUS=Monitoring memory status...")
+        if drainer.state == "cancelled":
+            info(f"swapFC: chunk #{chunk.number} stays active")
+            return False
+        if drainer.state == "failed":
+            warn(f"swapFC: swapoff of chunk #{chunk.number} failed")
+            return False
+        # A loop device is detached, and its file gone, as soon as swapoff is done.
+        if drainer.cancelled and os.path.isfile(chunk.swapfile):
+            info(f"swapFC: chunk #{chunk.number} was already freed, reactivating")
+            self.activator.enable(
+                what=chunk.swapfile,
+                priority=chunk.priority,
+                options=self.swap_options,
+                tag=f"swapfc_{chunk.number}",
+                file=chunk.swapfile,
+                loop=None,
+                size=chunk.size,
+                chunk=chunk.number,
+            )
+            return False
+        info(f"swapFC: chunk #{chunk.number} freed in {drainer.duration:.1f}s")
+        with span("swapfc_release", chunk=chunk.number):
+            force_remove(chunk.unit_path, verbose=True)
+            self.activator.forget(chunk.swapfile)
+            if os.path.isfile(chunk.swapfile) and not (
+                self.spares and self.spares.put(chunk.swapfile)
+            ):
+                force_remove(chunk.swapfile)
+        del self.chunks[chunk.number]
+        METRICS.inc("swapfc_deallocations_total")
+        return False
 
-    @staticmethod
-    def get_free_ram_perc() -> int:
-        ram_stats = get_mem_stats(["MemTotal", "MemFree"])
-        return round((ram_stats["MemFree"] * 100) / ram_stats["MemTotal"])
-
-    @staticmethod
-    def get_free_swap_perc() -> int:
-        swap_stats = get_mem_stats(["SwapTotal", "SwapFree"])
-        # Minimum for total is 1 to prevent divide by zero.
-        return round((swap_stats["SwapFree"] * 100) / max(swap_stats["SwapTotal"], 1))
+    def collect_metrics(self) -> None:
+        chunks = list(self.chunks.values())
+        METRICS.set("swapfc_chunks", len(chunks))
+        METRICS.reset("swapfc_chunk_size_bytes")
+        for chunk in chunks:
+            METRICS.set("swapfc_chunk_size_bytes", chunk.size, chunk=chunk.number)
+        METRICS.set("swapfc_polling_rate_seconds", self.polling_rate)
 
 
 def debug(msg: str) -> None:
@@ -451,6 +2047,29 @@ def error(msg: str) -> NoReturn:
     sys.exit(1)
 
 
+@contextlib.contextmanager
+def span(phase: str, **fields) -> Iterator[None]:
+    """Time a phase for the journal (SWAP_PHASE=, DURATION_US=) and the metrics."""
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - start_time
+        METRICS.observe("phase_duration_seconds", duration, phase=phase)
+        debug(f"{phase} took {duration * 1000:.1f}ms")
+        try:
+            systemd.journal.send(
+                f"{phase} took {duration * 1000:.1f}ms",
+                PRIORITY=str(systemd.journal.LOG_DEBUG),
+                SWAP_PHASE=phase,
+                DURATION_US=str(round(duration * 1000000)),
+                **{k.upper(): str(v) for k, v in fields.items()},
+            )
+        except OSError as e:
+            # A timing is not worth failing, or hiding an exception, for.
+            debug(f"Can't send {phase} timing to the journal: {e}")
+
+
 def force_remove(file: str, verbose: bool = False) -> None:
     try:
         os.remove(file)
@@ -488,13 +2107,45 @@ def am_i_root(exit_on_error: bool = True) -> bool:
 
 def find_swap_units() -> List[str]:
     swap_units = []
-    for path in ["/run/systemd/system", "/run/systemd/generator"]:
+    for path in ["/run/systemd/system", "/run/systemd/generator", f"{WORK_DIR}/units"]:
         for file_path in glob.glob(f"{path}/**/*.swap", recursive=True):
             if os.path.isfile(file_path) and not os.path.islink(file_path):
                 swap_units.append(file_path)
     return swap_units
 
 
+class SwapEntry:
+    __slots__ = ("name", "type", "size", "used", "priority")
+
+    def __init__(self, line: str):
+        name, self.type, size, used, priority = line.rsplit(None, 4)
+        # Names are escaped like in /proc/mounts.
+        self.name = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), name)
+        self.size = int(size) * 1024
+        self.used = int(used) * 1024
+        self.priority = int(priority)
+
+
+def get_active_swaps() -> Dict[str, SwapEntry]:
+    swaps = {}
+    with open(PROC_SWAPS) as f:
+        for line in f.read().splitlines()[1:]:
+            entry = SwapEntry(line)
+            swaps[entry.name] = entry
+    return swaps
+
+
+def sys_swapon(path: str, priority: Optional[int], options: Optional[str]) -> None:
+    flags = 0
+    if priority is not None and int(priority) >= 0:
+        flags |= SWAP_FLAG_PREFER | (int(priority) & SWAP_FLAG_PRIO_MASK)
+    if options and "discard" in options.split(","):
+        flags |= SWAP_FLAG_DISCARD
+    if LIBC.swapon(os.fsencode(path), flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+
 def get_what_from_swap_unit(file: str) -> str:
     with open(file) as file:
         for line in file.read().splitlines():
@@ -503,7 +2154,11 @@ def get_what_from_swap_unit(file: str) -> str:
 
 
 def gen_swap_unit(
-    what: str, tag: str, priority: Optional[int] = None, options: Optional[str] = None
+    what: str,
+    tag: str,
+    priority: Optional[int] = None,
+    options: Optional[str] = None,
+    unit_dir: str = f"{RUN_SYSD}/system",
 ) -> str:
     what = os.path.realpath(what)
     # Assume it's a file by default.
@@ -513,13 +2168,8 @@ def gen_swap_unit(
         _type = "Block/Partition"
         if "loop" in what:
             _type = "File"
-    unit_name = subprocess.run(
-        ["systemd-escape", "-p", "--suffix=swap", what],
-        check=True,
-        text=True,
-        stdout=subprocess.PIPE,
-    ).stdout.rstrip()
-    unit_path = f"{RUN_SYSD}/system/{unit_name}"
+    unit_name = f"{escape_path(what)}.swap"
+    unit_path = f"{unit_dir}/{unit_name}"
     content = (
         "[Unit]\n"
         f"Description=Swap {_type}\n"
@@ -537,6 +2187,8 @@ def gen_swap_unit(
     if options:
         content += f"Options={options}\n"
     write(content, unit_path)
+    if unit_dir != f"{RUN_SYSD}/system":
+        return unit_name
     relative_symlink(unit_path, f"{RUN_SYSD}/system/swap.target.wants/{unit_name}")
     if _type == "File":
         relative_symlink(
@@ -545,8 +2197,8 @@ def gen_swap_unit(
     return unit_name
 
 
-def swapoff(unit_path: str, subsystem: str) -> None:
-    dev = get_what_from_swap_unit(unit_path)
+def swapoff(unit_path: str, subsystem: str, dev: Optional[str] = None) -> None:
+    dev = dev or get_what_from_swap_unit(unit_path)
     info(f"{subsystem}: swapoff {dev}")
     subprocess.run(["swapoff", dev])
     force_remove(unit_path, verbose=True)
@@ -557,6 +2209,271 @@ def swapoff(unit_path: str, subsystem: str) -> None:
         subprocess.run(["zramctl", "-r", dev])
 
 
+def escape_path(path: str) -> str:
+    """Escape a path like systemd-escape --path does."""
+    path = "/".join(p for p in path.split("/") if p and p != ".")
+    if not path:
+        return "-"
+    escaped = []
+    for n, char in enumerate(path):
+        if char == "/":
+            escaped.append("-")
+        elif (
+            char.isascii()
+            and (char.isalnum() or char in ":_.")
+            and not (n == 0 and char == ".")
+        ):
+            escaped.append(char)
+        else:
+            escaped.extend(f"\\x{b:02x}" for b in char.encode())
+    return "".join(escaped)
+
+
+def get_fs_type(path: str) -> str:
+    """Return the filesystem type of path, detected by its statfs(2) magic."""
+    # f_type comes first in struct statfs, leave plenty of room for the rest.
+    buf = ctypes.create_string_buffer(256)
+    if LIBC.statfs(os.fsencode(path), buf) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    magic = ctypes.c_ulong.from_buffer(buf).value & 0xFFFFFFFF
+    return FS_MAGIC.get(magic, f"0x{magic:x}")
+
+
+def get_inode_flags(path: str) -> int:
+    """The flags lsattr shows."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        flags = bytearray(struct.pack("i", 0))
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags)
+        return struct.unpack("i", flags)[0]
+    finally:
+        os.close(fd)
+
+
+def get_nocow(path: str) -> bool:
+    return bool(get_inode_flags(path) & FS_NOCOW_FL)
+
+
+def aligned_buffer(size: int) -> mmap.mmap:
+    """A zeroed buffer for O_DIRECT IO."""
+    # Anonymous mappings are page aligned.
+    return mmap.mmap(-1, size)
+
+
+def set_nocow(path: str) -> None:
+    """chattr +C path, must be done while the file is still empty."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        flags = bytearray(struct.pack("i", 0))
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags)
+        flags = struct.pack("i", struct.unpack("i", flags)[0] | FS_NOCOW_FL)
+        fcntl.ioctl(fd, FS_IOC_SETFLAGS, flags)
+    finally:
+        os.close(fd)
+
+
+def mkswap(path: str, label: str) -> None:
+    """Write a version 1 swap header, like mkswap -L label path.
+
+    Meant for fresh files and devices, no other signatures are wiped.
+    """
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size < 10 * PAGE_SIZE:
+            raise OSError(errno.EINVAL, "swap space needs to be at least 10 pages")
+        uuid = bytearray(os.urandom(16))
+        # Random (version 4) UUID.
+        uuid[6] = uuid[6] & 0x0F | 0x40
+        uuid[8] = uuid[8] & 0x3F | 0x80
+        # After 1024 bytes of boot sector: version, last_page, nr_badpages, uuid,
+        # volume_name.
+        header = struct.pack(
+            "=III16s16s",
+            1,
+            size // PAGE_SIZE - 1,
+            0,
+            bytes(uuid),
+            label.encode()[:16],
+        )
+        page = bytearray(PAGE_SIZE)
+        page[1024 : 1024 + len(header)] = header
+        page[PAGE_SIZE - 10 :] = b"SWAPSPACE2"
+        os.pwrite(fd, page, 0)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def notify_ready() -> None:
+    duration = time.monotonic() - START_TIME
+    info(f"Started in {duration:.3f}s")
+    METRICS.set("startup_seconds", duration)
+    systemd.daemon.notify("READY=1")
+
+
+class Teardown:
+    """Swap off the units of a stop, in parallel where memory allows."""
+
+    subsystems = ["swapD", "swapFC", "Zram"]
+    # Percent of RAM left alone.
+    reserve_perc = 5
+    # swapoff mostly waits for IO, memory is the actual limit.
+    workers = 16
+
+    def __init__(self, unit_paths: List[str]):
+        self.units = {s: [] for s in self.subsystems}
+        for unit_path in unit_paths:
+            content = read(unit_path)
+            what = re.search(r"^What=(.*)$", content, re.M)
+            for subsystem in self.subsystems:
+                if subsystem.lower() in content and what:
+                    self.units[subsystem].append((unit_path, what.group(1)))
+                    break
+
+    @classmethod
+    def from_state(cls, state: StateManifest, keep: List[str]) -> Teardown:
+        """Take the units from the manifest, skipping swaps already gone.
+
+        Only the records of the subsystems in keep are left in the manifest.
+        """
+        teardown = cls([])
+        for what, record in state.reconcile(get_active_swaps()).items():
+            info(f"{record['subsystem']}: {what} is not active anymore")
+            force_remove(record["unit"], verbose=True)
+        for what, record in list(state.swaps.items()):
+            if record["subsystem"] not in keep:
+                teardown.units[record["subsystem"]].append((record["unit"], what))
+                del state.swaps[what]
+        return teardown
+
+    def run(self) -> None:
+        start_time = time.monotonic()
+        count = sum(len(u) for u in self.units.values())
+        # Zram last, it is the fastest place for pages to go meanwhile.
+        self.drain(
+            [("swapD", *u) for u in self.units["swapD"]]
+            + [("swapFC", *u) for u in self.units["swapFC"]]
+        )
+        self.drain([("Zram", *u) for u in self.units["Zram"]])
+        if count:
+            info(
+                f"Swapped off {count} device(s) in {time.monotonic() - start_time:.1f}s"
+            )
+
+    def drain(self, pending: List[Tuple[str, str, str]]) -> None:
+        swaps = get_active_swaps()
+
+        def used(what: str) -> int:
+            entry = swaps.get(os.path.realpath(what)) or swaps.get(what)
+            return entry.used if entry else 0
+
+        # Longest first, so that the last one doesn't start late.
+        pending.sort(key=lambda p: used(p[2]), reverse=True)
+        # swapoff needs RAM for the pages it reads back. Start one only while the
+        # used swap of all running ones fits into available memory, but always one.
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            while pending or running:
+                swaps = get_active_swaps()
+                sample = MEMINFO.sample()
+                budget = (
+                    sample.mem_available - sample.mem_total * self.reserve_perc / 100
+                )
+                budget -= sum(used(what) for _, _, what in running.values())
+                for item in list(pending):
+                    if len(running) >= self.workers:
+                        break
+                    _, _, what = item
+                    if running and used(what) > budget:
+                        continue
+                    budget -= used(what)
+                    pending.remove(item)
+                    running[executor.submit(self.swapoff, *item)] = item
+                done, _ = concurrent.futures.wait(
+                    running, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    del running[future]
+                    future.result()
+
+    @staticmethod
+    def swapoff(subsystem: str, unit_path: str, what: str) -> None:
+        with span(
+            "stop_swapoff", unit=os.path.basename(unit_path), subsystem=subsystem
+        ):
+            swapoff(unit_path, subsystem, what)
+
+
+def is_rotational(device: str) -> bool:
+    """Whether the disk behind device spins, partitions take it from their disk."""
+    name = os.path.basename(os.path.realpath(device))
+    sys_dev = os.path.realpath(f"/sys/class/block/{name}")
+    if os.path.isfile(f"{sys_dev}/partition"):
+        sys_dev = os.path.dirname(sys_dev)
+    try:
+        return read(f"{sys_dev}/queue/rotational").strip() == "1"
+    except OSError:
+        # Can't tell, rank it with the slow ones.
+        return True
+
+
+def probe_iops(device: str, duration: float = 0.5) -> float:
+    """Random 4K reads per second from device, bypassing the page cache."""
+    block_size = 4096
+    rng = random.Random(0)
+    count = 0
+    with aligned_buffer(block_size) as buf:
+        fd = os.open(device, os.O_RDONLY | os.O_CLOEXEC | os.O_DIRECT)
+        try:
+            blocks = os.lseek(fd, 0, os.SEEK_END) // block_size
+            if not blocks:
+                raise OSError(errno.EINVAL, "device is empty", device)
+            start_time = time.monotonic()
+            deadline = start_time + duration
+            while time.monotonic() < deadline:
+                os.preadv(fd, [buf], rng.randrange(blocks) * block_size)
+                count += 1
+            return count / (time.monotonic() - start_time)
+        finally:
+            os.close(fd)
+
+
+def swapd_tiers(devices: List[str], priority: int, benchmark: bool) -> Dict[str, int]:
+    """Give devices of the same speed tier the same priority, faster tiers higher."""
+    probes = {}
+    for device in devices:
+        iops = None
+        if benchmark:
+            try:
+                iops = probe_iops(device)
+            except OSError as e:
+                warn(f"swapD: can't benchmark {device}: {e.strerror}")
+        probes[device] = (is_rotational(device), iops)
+    ranked = sorted(devices, key=lambda d: (probes[d][0], -(probes[d][1] or 0)))
+    priorities = {}
+    leader = None
+    for device in ranked:
+        rotational, iops = probes[device]
+        if leader is not None:
+            leader_rotational, leader_iops = probes[leader]
+            if rotational != leader_rotational or (
+                iops is not None and leader_iops and iops < leader_iops / 2
+            ):
+                leader = None
+                priority -= 1
+        if leader is None:
+            leader = device
+        priorities[device] = priority
+        speed = f", {iops:.0f} IOPS" if iops is not None else ""
+        info(
+            f"swapD: {device}: {'rotational' if rotational else 'non-rotational'}"
+            f"{speed}, priority {priority}"
+        )
+    return priorities
+
+
 def makedirs(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
@@ -575,6 +2492,7 @@ def init_directories() -> None:
     makedirs(WORK_DIR)
     makedirs(f"{RUN_SYSD}/system/local-fs.target.wants")
     makedirs(f"{RUN_SYSD}/system/swap.target.wants")
+    makedirs(f"{WORK_DIR}/units")
 
 
 def start() -> None:
@@ -590,37 +2508,57 @@ def start() -> None:
         makedirs(f"{WORK_DIR}/swapd")
         swapd_prio = config.get("swapd_prio", int)
         # blkid returns 2 if nothing was found.
-        devices = subprocess.run(
-            ["blkid", "-t", "TYPE=swap", "-o", "device"],
-            text=True,
-            stdout=subprocess.PIPE,
-        ).stdout.splitlines()
-        for device in devices:
-            if "zram" in device or "loop" in device:
-                continue
-            used_devices = subprocess.run(
-                ["swapon", "--show=NAME", "--noheadings"],
-                check=True,
+        with span("swapd_blkid"):
+            devices = subprocess.run(
+                ["blkid", "-t", "TYPE=swap", "-o", "device"],
                 text=True,
                 stdout=subprocess.PIPE,
             ).stdout.splitlines()
-            for used_device in used_devices:
-                if device == used_device:
-                    device = None
-            if device is None:
+        active_swaps = {os.path.realpath(name) for name in get_active_swaps()}
+        candidates = []
+        for device in devices:
+            if "zram" in device or "loop" in device:
+                continue
+            if os.path.realpath(device) in active_swaps:
                 continue
             mode = os.stat(device).st_mode
             if not stat.S_ISBLK(mode):
                 continue
-            unit_name = gen_swap_unit(
-                what=device, options="discard", priority=swapd_prio, tag="swapd"
+            candidates.append(device)
+        if config.get("swapd_tiering", bool):
+            with span("swapd_tiering"):
+                priorities = swapd_tiers(
+                    candidates, swapd_prio, config.get("swapd_benchmark", bool)
+                )
+        else:
+            priorities = {d: swapd_prio - n for n, d in enumerate(candidates)}
+        units = {}
+        for device in candidates:
+            unit_name = activator.add(
+                what=device,
+                options="discard",
+                priority=priorities[device],
+                tag="swapd",
             )
-            subprocess.run(["systemctl", "daemon-reload"], check=True)
-            ret_code = subprocess.run(["systemctl", "start", unit_name]).returncode
-            if ret_code != 0:
-                continue
-            info(f"swapD: enabled device: {device}")
-            swapd_prio -= 1
+            units[unit_name] = device
+        start_time = time.monotonic()
+        activator.reload()
+
+        def start_unit(unit_name: str) -> Tuple[bool, float]:
+            start_time = time.monotonic()
+            ok = activator.start(unit_name)
+            return ok, time.monotonic() - start_time
+
+        with concurrent.futures.ThreadPoolExecutor(max(len(units), 1)) as executor:
+            results = executor.map(start_unit, units)
+            for (unit_name, device), (ok, duration) in zip(units.items(), results):
+                if ok:
+                    info(f"swapD: enabled device: {device} ({duration:.3f}s)")
+                else:
+                    warn(f"swapD: failed to enable device: {device}")
+        if units:
+            duration = time.monotonic() - start_time
+            info(f"swapD: activation took {duration:.3f}s")
         systemd.daemon.notify("STATUS=Swap unit activation finished")
 
     def start_zswap() -> None:
@@ -631,7 +2569,8 @@ def start() -> None:
         makedirs(f"{WORK_DIR}/zswap")
         for file in os.listdir(ZSWAP_M_P):
             file_path = os.path.join(ZSWAP_M_P, file)
-            zswap_parameters[file_path] = read(file_path)
+            state.zswap_parameters[file_path] = read(file_path)
+        state.save()
         info("Zswap: backup current configuration: complete")
         info("Zswap: set new parameters: start")
         info(
@@ -645,6 +2584,17 @@ def start() -> None:
         write(config.get("zswap_max_pool_percent"), f"{ZSWAP_M_P}/max_pool_percent")
         write(config.get("zswap_zpool"), f"{ZSWAP_M_P}/zpool")
         info("Zswap: set new parameters: complete")
+        if yn("zswap_pool_controller"):
+            if os.path.isdir(ZSWAP_D):
+                tasks.append(
+                    ZswapController(
+                        config.get("zswap_pool_interval", int),
+                        config.get("zswap_pool_min_percent", int),
+                        config.get("zswap_pool_max_percent", int),
+                    )
+                )
+            else:
+                warn(f"Zswap: {ZSWAP_D} not available, pool controller disabled")
 
     def start_zram() -> None:
         systemd.daemon.notify("STATUS=Setting up Zram...")
@@ -654,8 +2604,7 @@ def start() -> None:
         else:
             info("Zram: module found!")
 
-        def zram_init() -> None:
-            info("Zram: trying to initialize free device")
+        def zramctl_init() -> Optional[str]:
             output = None
             success = False
             for n in range(3):
@@ -683,7 +2632,7 @@ def start() -> None:
             # Try limit reached.
             if not success:
                 warn("Zram: device or resource was busy too many times")
-                return
+                return None
             zram_dev = None
             if "zramctl: no free zram device found" in output:
                 warn("Zram: zramctl can't find free device")
@@ -700,31 +2649,133 @@ def start() -> None:
             elif "/dev/zram" in output:
                 mode = os.stat(output).st_mode
                 if not stat.S_ISBLK(mode):
-                    return
+                    return None
                 zram_dev = output
             else:
                 error(f"Zram: unexpected output from zramctl: {output}")
+            return zram_dev
+
+        def sysfs_init() -> Optional[str]:
+            # The backing device must be set before the disk size, which zramctl
+            # can't do.
+            name = None
+            active_swaps = get_active_swaps()
+            for path in sorted(glob.glob("/sys/block/zram*")):
+                if read(f"{path}/disksize").strip() == "0":
+                    if f"/dev/{os.path.basename(path)}" not in active_swaps:
+                        name = os.path.basename(path)
+                        break
+            if name is None:
+                if not os.path.isfile("/sys/class/zram-control/hot_add"):
+                    warn("Zram: can't find or hot add a free device")
+                    return None
+                name = f'zram{read("/sys/class/zram-control/hot_add").rstrip()}'
+            sysfs = f"/sys/block/{name}"
+            writeback = False
+            if zram_writeback and os.path.isfile(f"{sysfs}/backing_dev"):
+                writeback = set_backing_dev(sysfs)
+            elif zram_writeback:
+                warn("Zram: writeback is not supported by the kernel")
+            write(config.get("zram_alg"), f"{sysfs}/comp_algorithm")
+            recompress = False
+            if recomp_algs and os.path.isfile(f"{sysfs}/recomp_algorithm"):
+                recompress = set_recomp_algorithms(sysfs)
+            elif recomp_algs:
+                warn("Zram: recompression is not supported by the kernel")
+            write(str(zram_size), f"{sysfs}/disksize")
+            if writeback or recompress:
+                tasks.append(
+                    ZramScheduler(
+                        sysfs,
+                        config.get("zram_writeback_interval", int) if writeback else 0,
+                        config.get("zram_writeback_threshold", int),
+                        config.get("zram_recomp_interval", int) if recompress else 0,
+                        config.get("zram_recomp_type"),
+                    )
+                )
+            return f"/dev/{name}"
 
-            mode = os.stat(zram_dev).st_mode
-            if stat.S_ISBLK(mode):
+        def set_recomp_algorithms(sysfs: str) -> bool:
+            # Secondary algorithms are tried in priority order, 1 being the first.
+            try:
+                for priority, alg in enumerate(recomp_algs, 1):
+                    write(
+                        f"algo={alg} priority={priority}", f"{sysfs}/recomp_algorithm"
+                    )
+            except OSError as e:
+                warn(f"Zram: can't set recompression algorithm {alg}: {e.strerror}")
+                return False
+            info(f"Zram: recompress with {' '.join(recomp_algs)}")
+            return True
+
+        def set_backing_dev(sysfs: str) -> bool:
+            backing_dev = config.get("zram_writeback_dev")
+            loop_dev = None
+            try:
+                mode = os.stat(backing_dev).st_mode
+                if stat.S_ISREG(mode):
+                    loop_dev = subprocess.run(
+                        ["losetup", "-f", "--show", backing_dev],
+                        check=True,
+                        text=True,
+                        stdout=subprocess.PIPE,
+                    ).stdout.rstrip()
+                    backing_dev = loop_dev
+            except OSError as e:
+                warn(f"Zram: can't use {backing_dev} for writeback: {e.strerror}")
+                return False
+            except subprocess.CalledProcessError:
+                warn(f"Zram: can't attach {backing_dev} to a loop device")
+                return False
+            success = True
+            try:
+                write(backing_dev, f"{sysfs}/backing_dev")
+                info(f"Zram: writeback to {config.get('zram_writeback_dev')}")
+            except OSError as e:
+                warn(f"Zram: can't use {backing_dev} for writeback: {e.strerror}")
+                success = False
+            if loop_dev:
+                # Zram holds the loop device open, it is cleared once zram lets go.
+                subprocess.run(["losetup", "-d", loop_dev])
+            return success
+
+        def zram_init() -> None:
+            info("Zram: trying to initialize free device")
+            with span("zram_init"):
+                with span("zram_setup"):
+                    if zram_writeback or recomp_algs:
+                        zram_dev = sysfs_init()
+                    else:
+                        zram_dev = zramctl_init()
+                if zram_dev is None:
+                    return
+                mode = os.stat(zram_dev).st_mode
+                if not stat.S_ISBLK(mode):
+                    warn("Zram: can't get free zram device")
+                    return
                 info(f"Zram: initialized: {zram_dev}")
-                ret_code = subprocess.run(
-                    ["mkswap", zram_dev],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                ).returncode
+                with span("zram_mkswap", device=zram_dev):
+                    try:
+                        mkswap(zram_dev, "")
+                        ret_code = 0
+                    except OSError as e:
+                        warn(f"Zram: mkswap {zram_dev} failed: {e.strerror}")
+                        ret_code = 1
                 if ret_code == 0:
-                    unit_name = gen_swap_unit(
+                    activator.enable(
                         what=zram_dev,
                         options="discard",
-                        priority=config.get("zram_prio"),
+                        priority=config.get("zram_prio", int),
                         tag="zram",
                     )
-                    subprocess.run(["systemctl", "daemon-reload"], check=True)
-                    subprocess.run(["systemctl", "start", unit_name], check=True)
-            else:
-                warn("Zram: can't get free zram device")
 
+        zram_writeback = config.get("zram_writeback", bool)
+        if zram_writeback and not config.get("zram_writeback_dev"):
+            warn("Zram: zram_writeback_dev is not set, writeback disabled")
+            zram_writeback = False
+        recomp_algs = config.get("zram_recomp_algs").split()
+        if recomp_algs:
+            makedirs(f"{WORK_DIR}/zram")
         if KMAJOR <= 4 and KMINOR <= 7:
             zram_size = round(
                 config.get("zram_size", int) / config.get("zram_count", int)
@@ -748,6 +2799,30 @@ def start() -> None:
     except sysv_ipc.ExistentialError:
         error(f"{sys.argv[0]} already started")
     config = Config()
+    state = StateManifest.load() or StateManifest()
+    activator = SwapActivator(config.get("swap_activation"), state)
+    tasks = []
+    if config.get("metrics_socket") or config.get("metrics_textfile"):
+        METRICS.add_collector(collect_zram_metrics)
+        if os.path.isdir(ZSWAP_D):
+            METRICS.add_collector(collect_zswap_metrics)
+        metrics_socket = config.get("metrics_socket")
+        if metrics_socket:
+            try:
+                mode = int(config.get("metrics_socket_mode"), 8)
+            except ValueError:
+                warn("metrics_socket_mode must be an octal mode, reset to 0666")
+                mode = 0o666
+            try:
+                tasks.append(MetricsServer(metrics_socket, mode))
+            except OSError as e:
+                warn(f"Metrics: can't listen on {metrics_socket}: {e.strerror}")
+        if config.get("metrics_textfile"):
+            tasks.append(
+                MetricsTextfile(
+                    config.get("metrics_textfile"), config.get("metrics_interval", int)
+                )
+            )
     yn = lambda x: config.get(x, bool)
     if yn("zram_enabled") and (
         yn("zswap_enabled") or yn("swapfc_enabled") or yn("swapd_auto_swapon")
@@ -760,20 +2835,29 @@ def start() -> None:
         start_zswap()
     if yn("zram_enabled"):
         start_zram()
-    info("Writing destroy info...")
-    DestroyInfo(zswap_parameters).save()
     if yn("swapd_auto_swapon"):
-        start_swapd()
+        with span("swapd_start"):
+            start_swapd()
+    for task in tasks:
+        task.start()
     if yn("swapfc_enabled"):
-        swap_fc = SwapFc(config, sem)
+        swap_fc = SwapFc(config, sem, activator)
         swap_fc.run()
     else:
-        systemd.daemon.notify("READY=1")
+        notify_ready()
         # Done setting up. Allow cleanup to take place.
         sem.release()
+        if tasks:
+            signal.signal(signal.SIGTERM, sigterm_handler)
+            sigterm_event.wait()
 
 
 def stop(on_init: bool = False) -> None:
+    with span("stop", on_init=on_init):
+        stop_all(on_init)
+
+
+def stop_all(on_init: bool) -> None:
     am_i_root()
     config = Config()
     sem = None
@@ -791,100 +2875,274 @@ def stop(on_init: bool = False) -> None:
         sem = sysv_ipc.Semaphore(sem_id, flags=sysv_ipc.IPC_CREX)
         if not on_init:
             warn(f"{sys.argv[0]} might not be running")
-    destroy_info = DestroyInfo.load()
-    swap_units = find_swap_units()
-    swap_unit_found = None
-    for i in ["swapD", "swapFC", "Zram"]:
-        for unit_path in filter(lambda u, ix=i: ix.lower() in read(u), swap_units):
-            swapoff(unit_path, i)
-            swap_unit_found = True
-        if swap_unit_found:
-            swap_units = find_swap_units()
-            swap_unit_found = False
-    if destroy_info:
-        if os.path.isdir(f"{WORK_DIR}/zswap"):
-            info("Zswap: restore configuration: start")
-            for zswap_parameter, value in destroy_info.zswap_parameters.items():
+    # Left for the next start to adopt.
+    keep = []
+    if config.get("swapfc_enabled", bool) and config.get("swapfc_adopt", bool):
+        keep.append("swapFC")
+    state = StateManifest.load()
+    with span("stop_drain"):
+        if state:
+            Teardown.from_state(state, keep).run()
+        else:
+            Teardown(find_swap_units()).run()
+    if state and state.zswap_parameters:
+        info("Zswap: restore configuration: start")
+        with span("stop_zswap_restore"):
+            for zswap_parameter, value in state.zswap_parameters.items():
                 write(value, zswap_parameter)
-            info("Zswap: restore configuration: complete")
+        info("Zswap: restore configuration: complete")
     info("Removing working directory...")
     shutil.rmtree(WORK_DIR, ignore_errors=True)
-    swapfc_path = config.get("swapfc_path")
-    info(f"Removing files in {swapfc_path}...")
-    try:
-        for file in os.listdir(swapfc_path):
-            force_remove(os.path.join(swapfc_path, file), verbose=True)
-    except OSError:
-        pass
+    if config.get("metrics_socket"):
+        force_remove(config.get("metrics_socket"))
+    if keep:
+        if state and state.swaps:
+            info(f"Keeping {len(state.swaps)} device(s) for the next start")
+            state.zswap_parameters = {}
+            makedirs(WORK_DIR)
+            state.save()
+    else:
+        swapfc_path = config.get("swapfc_path")
+        info(f"Removing files in {swapfc_path}...")
+        try:
+            for file in os.listdir(swapfc_path):
+                force_remove(os.path.join(swapfc_path, file), verbose=True)
+        except OSError:
+            pass
     sem.remove()
 
 
-def status() -> None:
-    if not am_i_root(exit_on_error=False):
-        warn("Not root! Some output might be missing.")
-    swap_stats = get_mem_stats(["SwapTotal", "SwapFree"])
-    swap_used = swap_stats["SwapTotal"] - swap_stats["SwapFree"]
+def format_size(size: int) -> str:
+    """Format size in bytes the way util-linux does, e.g. 1.5G."""
+    unit = "B"
+    for next_unit in "KMGTPE":
+        if size < 1024:
+            break
+        size /= 1024
+        unit = next_unit
+    if unit == "B":
+        return f"{size}B"
+    return f"{size:.1f}".rstrip("0").rstrip(".") + unit
+
+
+def print_table(rows: List[List[object]], indent: str = ". ") -> None:
+    """Print rows aligned in columns, like column -t."""
+    rows = [[str(v) for v in row] for row in rows]
+    widths = collections.defaultdict(int)
+    for row in rows:
+        for n, value in enumerate(row):
+            widths[n] = max(widths[n], len(value))
+    for row in rows:
+        line = "  ".join(v.ljust(widths[n]) for n, v in enumerate(row))
+        print(f"{indent}{line.rstrip()}")
+
+
+def zswap_status() -> Optional[Dict[str, object]]:
+    if not os.path.isdir(ZSWAP_M):
+        return None
+    parameters = {f: read(f"{ZSWAP_M_P}/{f}").strip() for f in os.listdir(ZSWAP_M_P)}
+    stats = {}
     try:
-        if os.path.isdir("/sys/module/zswap"):
-            used_bytes = int(read("/sys/kernel/debug/zswap/pool_total_size"))
-            used_pages = used_bytes / PAGE_SIZE
-            stored_pages = int(read("/sys/kernel/debug/zswap/stored_pages"))
-            stored_bytes = stored_pages * PAGE_SIZE
-            ratio = 0
-            if stored_pages > 0:
-                ratio = used_pages * 100 / stored_pages
-            zswap_info = ""
-            for file in sorted(os.listdir("/sys/module/zswap/parameters")):
-                zswap_info += (
-                    f'. {file} {read(f"/sys/module/zswap/parameters/{file}")}\n'
-                )
-            subprocess.run(["column", "-t"], input=zswap_info, text=True)
-            zswap_info = ""
-            for file in sorted(os.listdir("/sys/kernel/debug/zswap")):
-                zswap_info += f'. . {file} {read(f"/sys/kernel/debug/zswap/{file}")}\n'
-            zswap_info += f". . compress_ratio {round(ratio)}%\n"
-            if swap_used > 0:
-                zswap_info += (
-                    f". . zswap_store/swap_store {stored_bytes}/{swap_used} "
-                    f"{round(stored_bytes * 100 / swap_used)}%\n"
-                )
-            print("Zswap:")
-            subprocess.run(["column", "-t"], input=zswap_info, text=True)
-    except:
+        for file in os.listdir(ZSWAP_D):
+            stats[file] = int(read(f"{ZSWAP_D}/{file}"))
+    except OSError:
         warn("Zswap info inaccesible")
-    zramctl = subprocess.run(
-        ["zramctl"], check=True, text=True, stdout=subprocess.PIPE
-    ).stdout
-    if "[SWAP]" in zramctl:  # pylint: disable=unsupported-membership-test
-        zramctl = zramctl.splitlines()
-        zram_info = ""
-        for line in zramctl:
-            if line.startswith("NAME") or "[SWAP]" in line:
-                if line.endswith("MOUNTPOINT"):
-                    line = line[: -len("MOUNTPOINT")]
-                elif line.endswith("[SWAP]"):
-                    line = line[: -len("[SWAP]")]
-                zram_info += f". {line}\n"
+    stored_bytes = stats.get("stored_pages", 0) * PAGE_SIZE
+    ratio = 0
+    if stored_bytes > 0:
+        ratio = stats.get("pool_total_size", 0) * 100 / stored_bytes
+    return {
+        "parameters": dict(sorted(parameters.items())),
+        "stats": dict(sorted(stats.items())),
+        "stored_bytes": stored_bytes,
+        "compress_ratio": round(ratio),
+    }
+
+
+def zram_status(active_swaps: Dict[str, SwapEntry]) -> List[Dict[str, object]]:
+    devices = []
+    for path in sorted(glob.glob("/sys/block/zram*")):
+        name = f"/dev/{os.path.basename(path)}"
+        if name not in active_swaps:
+            continue
+        mm_stat = [int(v) for v in read(f"{path}/mm_stat").split()]
+        io_stat = [int(v) for v in read(f"{path}/io_stat").split()]
+        algorithm = re.search(r"\[(\S+)\]", read(f"{path}/comp_algorithm"))
+        device = {
+            "name": name,
+            "algorithm": algorithm.group(1) if algorithm else None,
+            "disksize": int(read(f"{path}/disksize")),
+            "orig_data_size": mm_stat[0],
+            "compr_data_size": mm_stat[1],
+            "mem_used_total": mm_stat[2],
+            "mem_limit": mm_stat[3],
+            "mem_used_max": mm_stat[4],
+            "same_pages": mm_stat[5],
+            "pages_compacted": mm_stat[6],
+            "huge_pages": mm_stat[7] if len(mm_stat) > 7 else None,
+            "failed_reads": io_stat[0],
+            "failed_writes": io_stat[1],
+            "used": active_swaps[name].used,
+            "priority": active_swaps[name].priority,
+            "writeback": None,
+            "recompression": None,
+        }
+        if os.path.isfile(f"{path}/backing_dev"):
+            backing_dev = read(f"{path}/backing_dev").strip()
+            if backing_dev != "none":
+                # bd_stat counts 4K pages.
+                bd_stat = [int(v) * 4096 for v in read(f"{path}/bd_stat").split()]
+                device["writeback"] = {
+                    "backing_dev": backing_dev,
+                    "stored": bd_stat[0],
+                    "read": bd_stat[1],
+                    "written": bd_stat[2],
+                }
+        stats_path = f"{WORK_DIR}/zram/{os.path.basename(path)}.json"
+        if os.path.isfile(stats_path):
+            with open(stats_path) as f:
+                stats = json.load(f)
+            device["recompression"] = {
+                "time": stats["time"],
+                "orig_data_size_before": stats["before"][0],
+                "compr_data_size_before": stats["before"][1],
+                "orig_data_size_after": stats["after"][0],
+                "compr_data_size_after": stats["after"][1],
+            }
+        devices.append(device)
+    return devices
+
+
+def swap_status(entries: List[SwapEntry]) -> List[Dict[str, object]]:
+    return [
+        {
+            "name": e.name,
+            "type": e.type,
+            "size": e.size,
+            "used": e.used,
+            "priority": e.priority,
+        }
+        for e in entries
+    ]
+
+
+def status(as_json: bool = False) -> None:
+    if not am_i_root(exit_on_error=False):
+        warn("Not root! Some output might be missing.")
+    swap_used = MEMINFO.sample().swap_used
+    active_swaps = get_active_swaps()
+    manifest = StateManifest.load()
+    swapd, swapfc = [], []
+    for entry in active_swaps.values():
+        if manifest:
+            record = manifest.get(entry.name)
+            subsystem = record["subsystem"] if record else None
+        elif entry.type == "file" or entry.name.startswith("/dev/loop"):
+            subsystem = "swapFC"
+        elif not entry.name.startswith("/dev/zram"):
+            subsystem = "swapD"
+        else:
+            subsystem = None
+        if subsystem == "swapFC":
+            swapfc.append(entry)
+        elif subsystem == "swapD":
+            swapd.append(entry)
+    state = {
+        "swap_used": swap_used,
+        "zswap": zswap_status(),
+        "zram": zram_status(active_swaps),
+        "swapd": swap_status(swapd) if os.path.isdir(f"{WORK_DIR}/swapd") else [],
+        "swapfc": swap_status(swapfc) if os.path.isdir(f"{WORK_DIR}/swapfc") else [],
+    }
+    if as_json:
+        json.dump(state, sys.stdout, indent=2)
+        print()
+        return
+    zswap = state["zswap"]
+    if zswap is not None:
+        print("Zswap:")
+        print_table(list(zswap["parameters"].items()))
+        rows = [[k, v] for k, v in zswap["stats"].items()]
+        rows.append(["compress_ratio", f'{zswap["compress_ratio"]}%'])
+        if swap_used > 0:
+            stored_bytes = zswap["stored_bytes"]
+            rows.append(
+                [
+                    "zswap_store/swap_store",
+                    f"{stored_bytes}/{swap_used}",
+                    f"{round(stored_bytes * 100 / swap_used)}%",
+                ]
+            )
+        print_table(rows, ". . ")
+    if state["zram"]:
         print("Zram:")
-        subprocess.run(["column -t | uniq"], input=zram_info, text=True, shell=True)
-    if os.path.isdir(f"{WORK_DIR}/swapd"):
-        swapon = subprocess.run(
-            ["swapon", "--raw"], check=True, text=True, stdout=subprocess.PIPE
-        ).stdout.splitlines()
-        swapd_info = "".join(
-            [f". {line}\n" for line in swapon if not re.search("zram|file|loop", line)]
+        print_table(
+            [["NAME", "ALGORITHM", "DISKSIZE", "DATA", "COMPR", "TOTAL", "PRIO"]]
+            + [
+                [
+                    d["name"],
+                    d["algorithm"],
+                    format_size(d["disksize"]),
+                    format_size(d["orig_data_size"]),
+                    format_size(d["compr_data_size"]),
+                    format_size(d["mem_used_total"]),
+                    d["priority"],
+                ]
+                for d in state["zram"]
+            ],
         )
-        print("swapD:")
-        subprocess.run(["column", "-t"], input=swapd_info, text=True)
-    if os.path.isdir(f"{WORK_DIR}/swapfc"):
-        swapon = subprocess.run(
-            ["swapon", "--raw"], check=True, text=True, stdout=subprocess.PIPE
-        ).stdout.splitlines()
-        swapfc_info = "".join(
-            [f". {line}\n" for line in swapon if re.search("NAME|file|loop", line)]
+    zram_writeback = [d for d in state["zram"] if d["writeback"]]
+    if zram_writeback:
+        print("Zram writeback:")
+        print_table(
+            [["NAME", "BACKING_DEV", "STORED", "READ", "WRITTEN"]]
+            + [
+                [
+                    d["name"],
+                    d["writeback"]["backing_dev"],
+                    format_size(d["writeback"]["stored"]),
+                    format_size(d["writeback"]["read"]),
+                    format_size(d["writeback"]["written"]),
+                ]
+                for d in zram_writeback
+            ],
         )
-        print("swapFC:")
-        subprocess.run(["column", "-t"], input=swapfc_info, text=True)
+    zram_recomp = [d for d in state["zram"] if d["recompression"]]
+    if zram_recomp:
+        rows = []
+        for d in zram_recomp:
+            r = d["recompression"]
+            compr_before = r["compr_data_size_before"]
+            compr_after = r["compr_data_size_after"]
+            rows.append(
+                [
+                    d["name"],
+                    f'{r["orig_data_size_before"] / max(compr_before, 1):.2f}',
+                    f'{r["orig_data_size_after"] / max(compr_after, 1):.2f}',
+                    format_size(max(compr_before - compr_after, 0)),
+                    time.strftime("%F %T", time.localtime(r["time"])),
+                ]
+            )
+        print("Zram recompression:")
+        print_table(
+            [["NAME", "RATIO_BEFORE", "RATIO_AFTER", "SAVED", "LAST_RUN"]] + rows
+        )
+    for name, key in [("swapD", "swapd"), ("swapFC", "swapfc")]:
+        if os.path.isdir(f"{WORK_DIR}/{key}"):
+            print(f"{name}:")
+            print_table(
+                [["NAME", "TYPE", "SIZE", "USED", "PRIO"]]
+                + [
+                    [
+                        e["name"],
+                        e["type"],
+                        format_size(e["size"]),
+                        format_size(e["used"]),
+                        e["priority"],
+                    ]
+                    for e in state[key]
+                ],
+            )
 
 
 def compression() -> None:
@@ -909,15 +3167,156 @@ def compression() -> None:
     print()
 
 
+def benchmark_corpus(size: int, corpus: Optional[str]) -> mmap.mmap:
+    """Return page aligned sample data, read from corpus or made up."""
+    if corpus:
+        size = os.path.getsize(corpus)
+    size = max(size - size % -PAGE_SIZE, PAGE_SIZE)
+    buf = mmap.mmap(-1, size)
+    if corpus:
+        with open(corpus, "rb") as f:
+            f.readinto(buf)
+        return buf
+    # A mix resembling anonymous memory: zero filled, heap-like structures, text
+    # and incompressible pages.
+    rng = random.Random(0)
+    words = [
+        bytes(
+            rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))
+        )
+        for _ in range(512)
+    ]
+    pool = {"zero": [bytes(PAGE_SIZE)], "heap": [], "text": [], "random": []}
+    for _ in range(64):
+        heap = bytearray()
+        while len(heap) < PAGE_SIZE:
+            pointer = 0x7F0000000000 + rng.randrange(1 << 20) * 16
+            heap += pointer.to_bytes(8, "little")
+            heap += rng.randrange(256).to_bytes(4, "little") + bytes(4)
+        pool["heap"].append(bytes(heap[:PAGE_SIZE]))
+        text = b" ".join(rng.choice(words) for _ in range(PAGE_SIZE // 4))
+        pool["text"].append(text[:PAGE_SIZE])
+        pool["random"].append(os.urandom(PAGE_SIZE))
+    kinds = ["zero"] * 10 + ["heap"] * 40 + ["text"] * 35 + ["random"] * 15
+    for offset in range(0, size, PAGE_SIZE):
+        buf[offset : offset + PAGE_SIZE] = rng.choice(pool[rng.choice(kinds)])
+    return buf
+
+
+def benchmark(size: int, corpus: Optional[str], as_json: bool = False) -> None:
+    am_i_root()
+    if not os.path.isfile("/sys/class/zram-control/hot_add"):
+        error("Zram: module not loaded or too old to hot add devices")
+    data = benchmark_corpus(size, corpus)
+    size = len(data)
+    block = mmap.mmap(-1, 1024 * 1024)
+    zram_id = read("/sys/class/zram-control/hot_add").strip()
+    sysfs = f"/sys/block/zram{zram_id}"
+    dev = f"/dev/zram{zram_id}"
+    results = []
+    try:
+        for _ in range(500):
+            if os.path.exists(dev):
+                break
+            time.sleep(0.01)
+        algorithms = read(f"{sysfs}/comp_algorithm").replace("[", "").replace("]", "")
+        for alg in algorithms.split():
+            write("1", f"{sysfs}/reset")
+            write(alg, f"{sysfs}/comp_algorithm")
+            write(str(size), f"{sysfs}/disksize")
+            # Compression and decompression happen synchronously in this thread.
+            fd = os.open(dev, os.O_RDWR | os.O_DIRECT)
+            try:
+                start_time, start_cpu = time.monotonic(), time.thread_time()
+                view = memoryview(data)
+                for offset in range(0, size, len(block)):
+                    os.write(fd, view[offset : offset + len(block)])
+                write_time = time.monotonic() - start_time
+                write_cpu = time.thread_time() - start_cpu
+                mm_stat = [int(v) for v in read(f"{sysfs}/mm_stat").split()]
+                os.lseek(fd, 0, os.SEEK_SET)
+                start_time, start_cpu = time.monotonic(), time.thread_time()
+                while os.readv(fd, [block]) > 0:
+                    pass
+                read_time = time.monotonic() - start_time
+                read_cpu = time.thread_time() - start_cpu
+            finally:
+                os.close(fd)
+            results.append(
+                {
+                    "algorithm": alg,
+                    "write_mib_s": round(size / (1024 * 1024) / write_time, 1),
+                    "read_mib_s": round(size / (1024 * 1024) / read_time, 1),
+                    "ratio": round(mm_stat[0] / max(mm_stat[1], 1), 2),
+                    "mem_used_total": mm_stat[2],
+                    "write_cpu": round(write_cpu, 3),
+                    "read_cpu": round(read_cpu, 3),
+                }
+            )
+    finally:
+        write("1", f"{sysfs}/reset")
+        write(zram_id, "/sys/class/zram-control/hot_remove")
+    # Swap in latency matters most: among the algorithms decompressing at least
+    # half as fast as the fastest one, take the one packing the most.
+    fastest = max(r["read_mib_s"] for r in results)
+    best = max(
+        (r for r in results if r["read_mib_s"] * 2 >= fastest),
+        key=lambda r: (r["ratio"], r["read_mib_s"]),
+    )
+    if as_json:
+        json.dump(
+            {"size": size, "results": results, "recommended": best["algorithm"]},
+            sys.stdout,
+            indent=2,
+        )
+        print()
+        return
+    print(f"Zram: {format_size(size)} of {corpus or 'synthetic data'}:")
+    print_table(
+        [["ALGORITHM", "WRITE", "READ", "RATIO", "MEM_USED", "CPU_WRITE", "CPU_READ"]]
+        + [
+            [
+                r["algorithm"],
+                f'{r["write_mib_s"]}MiB/s',
+                f'{r["read_mib_s"]}MiB/s',
+                r["ratio"],
+                format_size(r["mem_used_total"]),
+                f'{r["write_cpu"]}s',
+                f'{r["read_cpu"]}s',
+            ]
+            for r in results
+        ]
+    )
+    print(
+        f'Recommended: zram_alg={best["algorithm"]} '
+        f'zswap_compressor={best["algorithm"]}'
+    )
+
+
 def main() -> None:
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
         "command",
-        choices=["start", "stop", "status", "compression"],
+        choices=["start", "stop", "status", "compression", "benchmark"],
         default="status",
         nargs="?",
-        help="`start' the daemon, `stop' it, show some swap `status' info, or display "
-        "the loaded `compression' algorithms",
+        help="`start' the daemon, `stop' it, show some swap `status' info, display "
+        "the loaded `compression' algorithms, or `benchmark' them through zram",
+    )
+    argparser.add_argument(
+        "--json",
+        action="store_true",
+        help="print `status' or `benchmark' results as JSON",
+    )
+    argparser.add_argument(
+        "--size",
+        type=int,
+        default=256,
+        help="MiB of synthetic data to `benchmark' with",
+    )
+    argparser.add_argument(
+        "--corpus",
+        help="file to `benchmark' with instead of synthetic data",
     )
     args = argparser.parse_args()
     if args.command == "start":
@@ -925,9 +3324,11 @@ def main() -> None:
     elif args.command == "stop":
         stop()
     elif args.command == "status":
-        status()
+        status(args.json)
     elif args.command == "compression":
         compression()
+    elif args.command == "benchmark":
+        benchmark(args.size * 1024 * 1024, args.corpus, args.json)
     else:
         raise RuntimeError
 